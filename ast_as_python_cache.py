@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""A store of rendered modules on disk, shared by concurrent pytest runs.
+
+xdist workers, CI matrix jobs and developer runs on the same machine may all
+point at the same directory, so:
+
+* entries are written to a temporary file next to their final name, then
+  renamed over it, which readers see happen atomically;
+* reads take no lock: an entry is either complete, or missing;
+* the directory is kept under a size cap by evicting the entries of older
+  cache versions, then the least recently used ones, on a background thread
+  rather than in the import hook.
+
+Entries are named after a hash of everything their rendering depends on (see
+``AstAsPython.cache_key``), so processes racing to write one write the same
+text, and whichever rename lands last wins.
+"""
+import errno
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+class RenderCache(object):
+    """Rendered sources on disk, keyed by hex digests."""
+
+    # bump when the rendering of a tree or the keys change, older entries are
+    # then left for eviction
+    VERSION = 3
+    VERSION_DIRECTORY = re.compile(r'v\d+$')
+    TEMP_PREFIX = '.tmp-'
+    # seconds after which a temporary file is taken to be left over by a
+    # process that died while writing
+    STALE_TEMP_AGE = 3600
+
+    def __init__(self, directory, max_size):
+        self.root = directory
+        self.directory = os.path.join(directory, 'v%d' % self.VERSION)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # bytes written since the last eviction
+        self.written = 0
+        self.wake = threading.Event()
+        self.closing = False
+        self.thread = None
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key):
+        """Return the source stored under `key`, or None."""
+        path = self.path(key)
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                source = f.read()
+        except (IOError, OSError):
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            # the modification time orders the entries for eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return source
+
+    def put(self, key, source):
+        """Store `source` under `key`. Failing to is not an error: the
+        cache is only ever a shortcut."""
+        path = self.path(key)
+        data = source.encode('utf-8')
+        try:
+            makedirs(os.path.dirname(path))
+            fd, temp = tempfile.mkstemp(
+                prefix=self.TEMP_PREFIX, dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                replace(temp, path)
+            except Exception:
+                os.remove(temp)
+                raise
+        except (IOError, OSError):
+            return
+        with self.lock:
+            self.writes += 1
+            self.written += len(data)
+            wake = self.written * 8 >= self.max_size
+        if wake:
+            self.wake.set()
+
+    def start(self):
+        """Start evicting in the background, with a first pass for what
+        other runs left behind."""
+        self.thread = threading.Thread(
+            target=self.run, name='ast-as-python-cache-eviction')
+        self.thread.daemon = True
+        self.thread.start()
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            closing = self.closing
+            self.evict()
+            if closing:
+                return
+
+    def close(self):
+        """Make a last eviction pass, and wait for it."""
+        if self.thread is None:
+            return
+        self.closing = True
+        self.wake.set()
+        self.thread.join()
+        self.thread = None
+
+    def evict(self):
+        """Remove the entries of older versions, then the least recently
+        used ones, until the cache fits under its size cap."""
+        with self.lock:
+            self.written = 0
+        now = time.time()
+        entries = []
+        total = 0
+        try:
+            versions = [
+                os.path.join(self.root, name) for name in os.listdir(self.root)
+                if self.VERSION_DIRECTORY.match(name)
+            ]
+        except OSError:
+            versions = []
+        for directory, _, names in walk_all(versions):
+            current = (directory + os.sep).startswith(self.directory + os.sep)
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # evicted by another process
+                    continue
+                if name.startswith(self.TEMP_PREFIX):
+                    if now - stat.st_mtime > self.STALE_TEMP_AGE:
+                        remove(path)
+                    continue
+                entries.append((current, stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, _, size, path in entries:
+            if total <= self.max_size:
+                break
+            total -= size
+            if remove(path):
+                with self.lock:
+                    self.evictions += 1
+
+
+def walk_all(directories):
+    for directory in directories:
+        for item in os.walk(directory):
+            yield item
+
+def makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def remove(path):
+    """Remove `path`, and return whether it was this call that did."""
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    return True
+
+try:
+    replace = os.replace
+except AttributeError:
+    # Python 2, where rename only replaces an existing file on POSIX
+    replace = os.rename
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""Keep rewritten test modules rendered, and serve them over a Unix socket.
+
+Start the daemon in the project, then ask it for a test file::
+
+    $ python -m ast_as_python_daemon serve tests/ &
+    $ python -m ast_as_python_daemon show tests/test_foo.py
+
+The daemon loads pytest's configuration once, renders every test module up
+front, then polls their ``stat()`` and only re-renders the ones that change,
+so answering a query doesn't pay for pytest's startup or a full rewrite.
+"""
+from __future__ import print_function
+
+import argparse
+import ast
+import errno
+import fnmatch
+import inspect
+import os
+import socket
+import stat
+import sys
+import threading
+
+from _pytest.assertion.rewrite import rewrite_asserts
+
+import codegen
+
+
+DEFAULT_SOCKET = '.ast-as-python.sock'
+DEFAULT_PATTERNS = ['test_*.py', '*_test.py', 'conftest.py']
+
+try:
+    _rewrite_args = inspect.getfullargspec(rewrite_asserts).args
+except AttributeError:
+    # Python 2
+    _rewrite_args = inspect.getargspec(rewrite_asserts).args
+
+
+def render_file(path, config=None):
+    """Rewrite the asserts of the module at `path` and render it."""
+    with open(path, 'rb') as f:
+        source = f.read()
+    tree = ast.parse(source, path)
+    # the signature of rewrite_asserts depends on the pytest version
+    kwargs = {}
+    if 'source' in _rewrite_args:
+        kwargs['source'] = source
+    if 'module_path' in _rewrite_args:
+        kwargs['module_path'] = path
+    if 'config' in _rewrite_args:
+        kwargs['config'] = config
+    rewrite_asserts(tree, **kwargs)
+    return codegen.to_source(tree)
+
+
+def load_config(args):
+    """Parse pytest's configuration (ini files, initial conftests) once."""
+    from _pytest.config import _prepareconfig
+    return _prepareconfig(list(args))
+
+
+class Daemon(object):
+    """Renders the test modules under `dirs` and keeps them up to date."""
+
+    def __init__(self, socket_path, dirs, interval=0.5, config=None):
+        self.socket_path = socket_path
+        self.dirs = [os.path.abspath(d) for d in dirs]
+        self.interval = interval
+        self.config = config
+        if config is not None:
+            self.patterns = list(config.getini('python_files')) + ['conftest.py']
+        else:
+            self.patterns = DEFAULT_PATTERNS
+        # path -> ((mtime, size), rendered source)
+        self.rendered = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def files(self):
+        for top in self.dirs:
+            for dirpath, dirnames, filenames in os.walk(top):
+                dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+                for filename in filenames:
+                    if any(fnmatch.fnmatch(filename, p) for p in self.patterns):
+                        yield os.path.join(dirpath, filename)
+
+    def refresh(self):
+        """Re-render the modules that changed since the last refresh, and
+        forget those that were deleted."""
+        with self.lock:
+            paths = set(self.rendered)
+        paths.update(self.files())
+        for path in paths:
+            self.get(path)
+
+    def get(self, path):
+        """Return the rendered source of `path`, rendering it if it is
+        missing or stale."""
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            with self.lock:
+                self.rendered.pop(path, None)
+            return 'error: %s\n' % e
+        stamp = (st.st_mtime, st.st_size)
+        with self.lock:
+            cached = self.rendered.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        try:
+            source = render_file(path, self.config)
+        except Exception as e:
+            # a directory, an unreadable file or a failing rewrite: answer
+            # with the error rather than take the daemon down
+            source = 'error: %s\n' % e
+        with self.lock:
+            self.rendered[path] = (stamp, source)
+        return source
+
+    def poll(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                # keep watching, the next poll may well succeed
+                pass
+
+    def handle(self, conn):
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        try:
+            reply = self.get(data.decode('utf-8').strip())
+        except Exception as e:
+            reply = 'error: %s\n' % e
+        conn.sendall(reply.encode('utf-8'))
+
+    def serve_forever(self):
+        self.refresh()
+        poller = threading.Thread(target=self.poll)
+        poller.daemon = True
+        poller.start()
+
+        remove_stale_socket(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(16)
+        # wake up regularly to notice stop()
+        server.settimeout(self.interval)
+        try:
+            while not self.stopped.is_set():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                try:
+                    conn.settimeout(None)
+                    self.handle(conn)
+                except socket.error:
+                    # the client went away
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            os.unlink(self.socket_path)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def remove_stale_socket(path):
+    """Remove the socket at `path` if it was left by a daemon that is gone.
+
+    Anything else is left alone, a live daemon's socket included, and bind()
+    then fails on it.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        return
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error as e:
+        if e.errno == errno.ECONNREFUSED:
+            os.unlink(path)
+    finally:
+        client.close()
+
+
+def query(socket_path, path):
+    """Ask the daemon listening on `socket_path` for the rendered `path`."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall((os.path.abspath(path) + '\n').encode('utf-8'))
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    return b''.join(chunks).decode('utf-8')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help='Unix socket path (default: %s)' % DEFAULT_SOCKET)
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='start the daemon')
+    serve.add_argument('dirs', nargs='*', default=['.'], metavar='DIR')
+    serve.add_argument('--interval', type=float, default=0.5,
+                       help='seconds between polls (default: 0.5)')
+    show = commands.add_parser('show', help='print a rendered test module')
+    show.add_argument('file')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        daemon = Daemon(args.socket, args.dirs, args.interval,
+                        load_config(args.dirs))
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'show':
+        sys.stdout.write(query(args.socket, args.file))
+    else:
+        parser.print_usage()
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
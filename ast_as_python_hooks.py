@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""Hooks of pytest-ast-back-to-python, for other plugins to implement."""
+
+
+def pytest_ast_as_python_rendered(path, tree, source, timings):
+    """Called with each rewritten module, as soon as it is rendered.
+
+    :param path: absolute path of the module, or None if it isn't known.
+    :param tree: the rewritten ``ast.Module``. Don't modify it: pytest
+        compiles it as well.
+    :param source: the module rendered back to Python source.
+    :param timings: a dict with the seconds spent by the ``'rewrite'`` and
+        the ``'render'``.
+
+    With ``--ast-as-python-workers`` this is called from the worker threads.
+    Only called with ``--show-ast-as-python``; add
+    ``--ast-as-python-no-store`` when the terminal summary isn't needed.
+    """
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Compare the compiled ``codegen`` with the pure Python one.
+
+Usage::
+
+    AST_BACK_TO_PYTHON_COMPILE=1 python setup.py build_ext --inplace
+    python benchmarks/compiled.py [FILE ...]
+
+Both render the same rewritten modules; their output must be identical.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen
+
+from render import rewritten_tree, synthetic_source
+
+
+def load_pure():
+    path = os.path.join(ROOT, 'codegen.py')
+    module = types.ModuleType('codegen_pure')
+    module.__file__ = path
+    with open(path) as f:
+        code = compile(f.read(), path, 'exec')
+    exec(code, module.__dict__)
+    return module
+
+
+def main(argv=None):
+    paths = sys.argv[1:] if argv is None else argv
+    if not codegen.COMPILED:
+        print('codegen is not compiled, build it first (see %s)' % __file__)
+        return 1
+    pure = load_pure()
+
+    if paths:
+        sources = []
+        for path in paths:
+            with open(path) as f:
+                sources.append(f.read())
+    else:
+        sources = [synthetic_source()]
+    trees = [rewritten_tree(source) for source in sources]
+
+    for tree in trees:
+        for correct_line_numbers in (False, True):
+            compiled_output = codegen.to_source(
+                tree, correct_line_numbers=correct_line_numbers)
+            pure_output = pure.to_source(
+                tree, correct_line_numbers=correct_line_numbers)
+            if compiled_output != pure_output:
+                print('output differs!')
+                return 1
+
+    timings = {}
+    for name, module in (('pure', pure), ('compiled', codegen)):
+        def render():
+            for tree in trees:
+                module.to_source(tree)
+        timings[name] = min(timeit.repeat(render, number=1, repeat=5))
+        print('%-8s %.4fs' % (name, timings[name]))
+    print('speedup  %.2fx, output identical' % (
+        timings['pure'] / timings['compiled']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
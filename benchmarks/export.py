@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Compare loading exported modules with rewriting them.
+
+Usage::
+
+    python benchmarks/export.py [--repeat N] [FILE ...]
+
+Without files, the synthetic test module of ``render.py`` is used.  Each
+module is exported once to a temporary directory, then both ways of getting
+its code are timed: parsing, rewriting and compiling the source, the way
+pytest does, and ``Exporter.load``, which also reads and hashes the source to
+check the export is current.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytest_ast_back_to_python import Exporter, hash_source
+
+from render import rewritten_tree, synthetic_source
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rootdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        if args.files:
+            for path in args.files:
+                with open(path, 'rb') as f:
+                    source = f.read()
+                paths.append(os.path.join(rootdir, os.path.basename(path)))
+                with open(paths[-1], 'wb') as f:
+                    f.write(source)
+        else:
+            paths.append(os.path.join(rootdir, 'test_synthetic.py'))
+            with open(paths[-1], 'w') as f:
+                f.write(synthetic_source())
+
+        export_dir = os.path.join(rootdir, '.exported')
+        exporter = Exporter(export_dir, export_dir, rootdir)
+        for path in paths:
+            with open(path) as f:
+                tree = rewritten_tree(f.read())
+            source_sha1 = hash_source(None, path)
+            exporter.export(tree, path, source_sha1)
+            exporter.export_code(path, source_sha1, compile(tree, path, 'exec'))
+            assert exporter.load(path) is not None
+
+        def rewrite():
+            for path in paths:
+                with open(path) as f:
+                    compile(rewritten_tree(f.read()), path, 'exec')
+
+        def load():
+            for path in paths:
+                exporter.load(path)
+
+        print('%d modules' % len(paths))
+        for name, size in [
+                ('source', lambda path: path),
+                ('export', lambda path: exporter.target(
+                    os.path.relpath(path, rootdir))),
+                ('code', lambda path: exporter.target(
+                    os.path.relpath(path, rootdir)) + Exporter.CODE_SUFFIX)]:
+            print('%-8s %10d bytes' % (
+                name, sum(os.path.getsize(size(path)) for path in paths)))
+        for name, func in [('rewrite', rewrite), ('load', load)]:
+            best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            print('%-8s %8.4fs' % (name, best))
+    finally:
+        shutil.rmtree(rootdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Compare ``codegen.fingerprint`` with hashing ``ast.dump`` for trees.
+
+Usage::
+
+    python benchmarks/fingerprint.py [--include-attributes] [--repeat N] [FILE ...]
+
+Without files, the synthetic test module of ``render.py`` is used.  Each
+module has its asserts rewritten once, then is hashed whole, statement by
+statement, and statement by statement then whole with a shared memo.  It is
+compared with rendering, which a fingerprint has to beat to be worth taking
+before rendering.
+"""
+from __future__ import print_function
+
+import argparse
+import ast
+import hashlib
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codegen
+
+from render import rewritten_tree, synthetic_source
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--include-attributes', action='store_true')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.files:
+        sources = []
+        for path in args.files:
+            with open(path) as f:
+                sources.append(f.read())
+    else:
+        sources = [synthetic_source()]
+    trees = [rewritten_tree(source) for source in sources]
+    statements = [statement for tree in trees for statement in tree.body]
+    attributes = args.include_attributes
+
+    def dump_hash(node):
+        dump = ast.dump(node, include_attributes=attributes)
+        return hashlib.sha1(dump.encode('utf-8')).digest()
+
+    def fingerprint(node, memo=None):
+        return codegen.fingerprint(node, memo, include_attributes=attributes)
+
+    def memoized():
+        memo = {}
+        for statement in statements:
+            fingerprint(statement, memo)
+        for tree in trees:
+            fingerprint(tree, memo)
+
+    cases = [
+        ('modules', lambda: [dump_hash(tree) for tree in trees],
+         lambda: [fingerprint(tree) for tree in trees]),
+        ('statements', lambda: [dump_hash(node) for node in statements],
+         lambda: [fingerprint(node) for node in statements]),
+        ('statements+modules',
+         lambda: [dump_hash(node) for node in statements + trees],
+         memoized),
+    ]
+    nodes = sum(1 for tree in trees for _ in ast.walk(tree))
+    print('%d modules, %d statements, %d nodes' % (
+        len(trees), len(statements), nodes))
+    print('%-20s %12s %13s %8s' % ('', 'ast.dump s', 'fingerprint s', 'speedup'))
+    for name, dump_case, fingerprint_case in cases:
+        dump_time = min(timeit.repeat(dump_case, number=1, repeat=args.repeat))
+        fingerprint_time = min(timeit.repeat(
+            fingerprint_case, number=1, repeat=args.repeat))
+        print('%-20s %12.4f %13.4f %7.2fx' % (
+            name, dump_time, fingerprint_time, dump_time / fingerprint_time))
+    render_time = min(timeit.repeat(
+        lambda: [codegen.to_source(tree) for tree in trees],
+        number=1, repeat=args.repeat))
+    print('%-20s %12.4f (codegen.to_source of the modules)' % (
+        'render', render_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Time and count allocations of ``codegen.to_source`` on rewritten modules.
+
+Usage::
+
+    python benchmarks/render.py [--correct-line-numbers] [--literals] [--formats] [FILE ...]
+
+Without files, a synthetic test module full of asserts is used, or with
+``--literals`` one embedding large multi-line string fixtures.  Each module
+has its asserts rewritten once, then is rendered repeatedly.  With
+``--formats`` only the ``@py_format`` assignments of the rewritten asserts,
+the most expression-heavy statements, are rendered, one at a time.
+"""
+from __future__ import print_function
+
+import argparse
+import ast
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _pytest.assertion.rewrite import rewrite_asserts
+
+import codegen
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+SYNTHETIC_TEST = '''
+def test_%(n)d(request, tmpdir):
+    data = {'a': [1, 2, 3], 'b': (4, 5), 'c': {'d': request.node.name}}
+    assert data['a'][0] + data['b'][1] * 2 == 11
+    assert request.config.getoption('verbose') >= 0, 'verbose %%r' %% data
+    assert not tmpdir.join('x%(n)d').check() and len(data) in (3, 4)
+    assert [x ** 2 for x in data['a'] if x %% 2] == [1, 9]
+'''
+
+
+SYNTHETIC_FIXTURE = '''
+FIXTURE_%(n)d = %(text)r
+FIXTURE_BYTES_%(n)d = %(data)r
+
+def test_fixture_%(n)d():
+    assert FIXTURE_%(n)d.count('\\n') > 10
+'''
+
+
+def synthetic_source(tests=500):
+    return ''.join(SYNTHETIC_TEST % {'n': n} for n in range(tests))
+
+
+def synthetic_literals(fixtures=50):
+    row = '{"id": %d, "name": "row \\\\ %d", "tags": [\'a\', "b"]},\n'
+    text = 'SELECT *\nFROM t\tWHERE x = \'%s\'\n' + ''.join(row % (i, i) for i in range(1000))
+    return ''.join(
+        SYNTHETIC_FIXTURE % {'n': n, 'text': text, 'data': text.encode('utf-8')}
+        for n in range(fixtures))
+
+
+def rewritten_tree(source):
+    tree = ast.parse(source)
+    try:
+        rewrite_asserts(tree, source.encode('utf-8'))
+    except TypeError:
+        # pytest < 5 doesn't take the source
+        rewrite_asserts(tree)
+    return tree
+
+
+def format_statements(tree):
+    return [
+        node for node in ast.walk(tree)
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and
+        isinstance(node.targets[0], ast.Name) and
+        node.targets[0].id.startswith('@py_format')
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--correct-line-numbers', action='store_true')
+    parser.add_argument('--literals', action='store_true')
+    parser.add_argument('--formats', action='store_true')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.files:
+        sources = []
+        for path in args.files:
+            with open(path) as f:
+                sources.append(f.read())
+    elif args.literals:
+        sources = [synthetic_literals()]
+    else:
+        sources = [synthetic_source()]
+    trees = [rewritten_tree(source) for source in sources]
+    if args.formats:
+        trees = [node for tree in trees for node in format_statements(tree)]
+    nodes = sum(1 for tree in trees for _ in ast.walk(tree))
+
+    def render():
+        for tree in trees:
+            codegen.to_source(
+                tree, correct_line_numbers=args.correct_line_numbers)
+
+    render()
+    best = min(timeit.repeat(render, number=1, repeat=args.repeat))
+    print('%d %s, %d nodes' % (
+        len(trees), 'format statements' if args.formats else 'modules', nodes))
+    print('render: %.4fs best of %d, %.0f nodes/s' % (
+        best, args.repeat, nodes / best))
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        render()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('memory: %.1f KiB peak while rendering' % (peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Check that ``codegen`` output re-parses to the same AST, and time it.
+
+Usage::
+
+    python benchmarks/roundtrip.py [--no-stdlib] [--no-site-packages] [DIR ...]
+
+Every module of the corpus (the stdlib, the test suites installed in
+site-packages and any DIR given) is rendered twice: as parsed, and after
+``rewrite_asserts``.  Each rendering is parsed again and its ``ast.dump``
+compared with that of the tree it came from.  The work is spread over a
+process pool; failures and the rendering throughput are reported at the end.
+"""
+from __future__ import print_function
+
+import argparse
+import ast
+import fnmatch
+import multiprocessing
+import os
+import sys
+import sysconfig
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _pytest.assertion.rewrite import rewrite_asserts
+
+import codegen
+from pytest_ast_back_to_python import mangle_names
+
+
+TEST_PATTERNS = ('test_*.py', '*_test.py')
+
+
+def iter_modules(top, patterns=('*.py',), exclude=()):
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames[:] = sorted(
+            name for name in dirnames
+            if os.path.join(dirpath, name) not in exclude)
+        for filename in sorted(filenames):
+            if any(fnmatch.fnmatch(filename, pattern) for pattern in patterns):
+                yield os.path.join(dirpath, filename)
+
+
+def corpus(dirs, stdlib=True, site_packages=True):
+    paths = sysconfig.get_paths()
+    packages = set([paths['purelib'], paths['platlib']])
+    if stdlib:
+        for path in iter_modules(paths['stdlib'], exclude=packages):
+            yield path
+    if site_packages:
+        for top in sorted(packages):
+            for path in iter_modules(top, TEST_PATTERNS):
+                yield path
+    for top in dirs:
+        for path in iter_modules(top):
+            yield path
+
+
+def rewrite(tree, source):
+    try:
+        rewrite_asserts(tree, source)
+    except TypeError:
+        # pytest < 5 doesn't take the source
+        rewrite_asserts(tree)
+
+
+def check_tree(tree):
+    """Return ``(nodes, seconds, error)`` for rendering one tree."""
+    expected = ast.dump(tree)
+    nodes = sum(1 for _ in ast.walk(tree))
+    start = timer()
+    try:
+        source = codegen.to_source(tree)
+    except Exception as e:
+        return nodes, timer() - start, 'render: %s: %s' % (type(e).__name__, e)
+    elapsed = timer() - start
+    try:
+        got = ast.dump(ast.parse(source))
+    except SyntaxError as e:
+        return nodes, elapsed, 'reparse: SyntaxError: %s' % e
+    if got != expected:
+        return nodes, elapsed, 'reparse: AST differs'
+    return nodes, elapsed, None
+
+
+def check_file(path):
+    """Return ``(path, results)``, with one ``(kind, nodes, seconds, error)``
+    per rendering, or no results if the file doesn't parse here."""
+    with open(path, 'rb') as f:
+        source = f.read()
+    try:
+        ast.parse(source)
+    except (SyntaxError, ValueError):
+        return path, []
+
+    results = []
+    for kind in ('original', 'rewritten'):
+        tree = ast.parse(source)
+        if kind == 'rewritten':
+            try:
+                rewrite(tree, source)
+            except Exception as e:
+                results.append((kind, 0, 0.0, 'rewrite: %s: %s' % (type(e).__name__, e)))
+                continue
+            # the rewritten names (@py_assert1, @pytest_ar, ...) can't be
+            # parsed, so give them names that can before rendering
+            mangle_names(tree)
+        results.append((kind,) + check_tree(tree))
+    return path, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('dirs', nargs='*', metavar='DIR')
+    parser.add_argument('--no-stdlib', action='store_true')
+    parser.add_argument('--no-site-packages', action='store_true')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='size of the process pool (default: one per CPU)')
+    parser.add_argument('--show', type=int, default=20, metavar='N',
+                        help='list at most N failures (default: 20)')
+    args = parser.parse_args(argv)
+
+    paths = list(corpus(args.dirs, not args.no_stdlib, not args.no_site_packages))
+    pool = multiprocessing.Pool(args.processes)
+    start = timer()
+    files = skipped = nodes = 0
+    seconds = 0.0
+    failures = []
+    try:
+        for path, results in pool.imap_unordered(check_file, paths, chunksize=8):
+            files += 1
+            if not results:
+                skipped += 1
+            for kind, tree_nodes, elapsed, error in results:
+                nodes += tree_nodes
+                seconds += elapsed
+                if error is not None:
+                    failures.append((path, kind, error))
+    finally:
+        pool.close()
+        pool.join()
+    wall = timer() - start
+
+    failures.sort()
+    for path, kind, error in failures[:args.show]:
+        print('FAIL %s (%s): %s' % (path, kind, error))
+    if len(failures) > args.show:
+        print('... and %d more' % (len(failures) - args.show))
+    print('%d files (%d skipped), %d renderings failed' % (
+        files, skipped, len(failures)))
+    print('%d nodes rendered in %.2fs of render time: %.0f nodes/s' % (
+        nodes, seconds, nodes / seconds if seconds else 0))
+    print('%.2fs wall clock: %.1f files/s' % (wall, files / wall if wall else 0))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
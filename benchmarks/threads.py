@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Measure how rendering scales over threads.
+
+Usage::
+
+    python benchmarks/threads.py [--modules N] [--threads 1,2,4,8]
+
+Renders N rewritten modules on thread pools of increasing size.  On a
+free-threaded CPython build the work runs in parallel; with the GIL the
+speedup stays around 1x.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codegen
+
+from render import rewritten_tree, synthetic_source
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modules', type=int, default=32)
+    parser.add_argument('--threads', default='1,2,4,8')
+    args = parser.parse_args(argv)
+
+    trees = [rewritten_tree(synthetic_source(50)) for _ in range(args.modules)]
+    expected = [codegen.to_source(tree) for tree in trees]
+
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)
+    print('GIL %s' % ('enabled' if is_gil_enabled() else 'disabled'))
+    baseline = None
+    for threads in [int(n) for n in args.threads.split(',')]:
+        pool = ThreadPool(threads)
+        try:
+            def render():
+                return pool.map(codegen.to_source, trees)
+            assert render() == expected
+            best = min(timeit.repeat(render, number=1, repeat=3))
+        finally:
+            pool.close()
+            pool.join()
+        baseline = baseline or best
+        print('%2d threads: %.4fs, %.2fx' % (threads, best, baseline / best))
+
+
+if __name__ == '__main__':
+    main()
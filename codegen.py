@@ -34,26 +34,30 @@
 """
 
 import sys
+from array import array
+from hashlib import md5
+from operator import attrgetter
+from timeit import default_timer as timer
 PY3 = sys.version_info >= (3, 0)
+
+# This module can be compiled with Cython (see setup.py). The compiled module
+# is then imported instead of this file, which stays the fallback.
+try:
+    import cython
+    COMPILED = cython.compiled
+except ImportError:
+    COMPILED = False
+# the builtin, before ast's node class of the same name shadows it
+ELLIPSIS = Ellipsis
 # These might not exist, so we put them equal to NoneType
 Try = TryExcept = TryFinally = YieldFrom = MatMult = Await = type(None)
 
 from ast import *
 
-class Sep(object):
-    # Performs the common pattern of returning a different symbol the first
-    # time the object is called
-    def __init__(self, last, first=''):
-        self.last = last
-        self.first = first
-        self.begin = True
-    def __call__(self):
-        if self.begin:
-            self.begin = False
-            return self.first
-        return self.last
-
-def to_source(node, indent_with=' ' * 4, add_line_information=False, correct_line_numbers=False):
+# per SourceGenerator class: node class -> visit method
+_dispatch_tables = {}
+
+def to_source(node, indent_with=' ' * 4, add_line_information=False, correct_line_numbers=False, profile=None):
     """This function can convert a node tree back into python sourcecode.
     This is useful for debugging purposes, especially if you're dealing with
     custom asts not generated by python itself.
@@ -70,14 +74,226 @@ def to_source(node, indent_with=' ' * 4, add_line_information=False, correct_lin
     If `add_line_information` is set to `True` comments for the line numbers
     of the nodes are added to the output.  This can be used to spot wrong line
     number information of statement nodes.
+
+    If `correct_line_numbers` is set to `True` every statement is rendered on
+    its line number, as far as the tree allows: statements sharing a line are
+    joined with semicolons, and blank lines or backslash continuations are
+    inserted to get to the next one.
+
+    If a `VisitorProfile` is given as `profile`, the calls, time and output of
+    every visit_* method are added to it.
+    """
+    return _generator(node, indent_with, add_line_information, correct_line_numbers,
+                      profile=profile).process(node)
+
+
+def to_source_with_map(node, indent_with=' ' * 4, add_line_information=False, correct_line_numbers=False, profile=None):
+    """Like `to_source`, but also return a source map of the output.
+
+    The source map is an ``array('i')`` with one item per rendered line, the
+    line number of the statement in `node` that produced it: item ``i`` maps
+    rendered line ``i + 1``.
     """
+    generator = _generator(node, indent_with, add_line_information, correct_line_numbers, True, profile)
+    source = generator.process(node)
+    return source, generator.source_map
+
+
+def _generator(node, indent_with, add_line_information, correct_line_numbers, source_map=False, profile=None):
     if correct_line_numbers:
         if hasattr(node, 'lineno'):
-            return SourceGenerator(indent_with, add_line_information, True, node.lineno).process(node)
+            generator = SourceGenerator(indent_with, add_line_information, True, node.lineno, source_map)
         else:
-            return SourceGenerator(indent_with, add_line_information, True).process(node)
+            generator = SourceGenerator(indent_with, add_line_information, True, source_map=source_map)
     else:
-        return SourceGenerator(indent_with, add_line_information).process(node)
+        generator = SourceGenerator(indent_with, add_line_information, source_map=source_map)
+    if profile is not None:
+        generator.dispatch = profile.dispatch_table(generator.__class__)
+    return generator
+
+
+class VisitorProfile(object):
+    """Counts the calls, time and output of each visit_* method.
+
+    Rendering with a profile swaps the dispatch table of the generator for
+    one whose methods are wrapped, so rendering without one pays nothing.
+    Methods that a visitor calls directly (visit_bare, visit_arguments, ...)
+    are counted as part of their caller.  A profile must only be used by one
+    thread at a time; `merge` adds one profile to another.
+    """
+
+    def __init__(self):
+        # method name -> [calls, cumulative seconds, own seconds, characters written]
+        self.stats = {}
+        self.tables = {}
+        # time spent in nested visits, for each visit in progress
+        self.nested = [0.0]
+
+    def dispatch_table(self, cls):
+        try:
+            return self.tables[cls]
+        except KeyError:
+            table = self.tables[cls] = _ProfiledDispatch(self, cls)
+            return table
+
+    def wrap(self, name, method):
+        stats = self.stats.setdefault(name, [0, 0.0, 0.0, 0])
+        nested = self.nested
+        # recursive calls only count once towards the cumulative figures
+        depth = [0]
+
+        def profiled(generator, node):
+            result = generator.result
+            first = len(result)
+            depth[0] += 1
+            nested.append(0.0)
+            start = timer()
+            try:
+                return method(generator, node)
+            finally:
+                elapsed = timer() - start
+                nested_time = nested.pop()
+                nested[-1] += elapsed
+                depth[0] -= 1
+                stats[0] += 1
+                stats[2] += elapsed - nested_time
+                if not depth[0]:
+                    stats[1] += elapsed
+                    stats[3] += sum(len(item) for item in result[first:])
+        return profiled
+
+    def merge(self, other):
+        for name, (calls, cumulative, own, written) in other.stats.items():
+            stats = self.stats.setdefault(name, [0, 0.0, 0.0, 0])
+            stats[0] += calls
+            stats[1] += cumulative
+            stats[2] += own
+            stats[3] += written
+
+    def table(self):
+        """Return the statistics as lines of text, most expensive first."""
+        lines = ['%9s %9s %9s %11s  %s' % ('calls', 'own s', 'cum s', 'chars', 'method')]
+        rows = sorted(self.stats.items(), key=lambda item: (-item[1][2], item[0]))
+        for name, (calls, cumulative, own, written) in rows:
+            lines.append('%9d %9.4f %9.4f %11d  %s' % (calls, own, cumulative, written, name))
+        return lines
+
+
+class _ProfiledDispatch(dict):
+    # a dispatch table that wraps each visit_* method as it is looked up
+    def __init__(self, profile, cls):
+        dict.__init__(self)
+        self.profile = profile
+        self.cls = cls
+
+    def __missing__(self, node_class):
+        name = 'visit_' + node_class.__name__
+        method = getattr(self.cls, name, None)
+        if method is None:
+            name, method = 'generic_visit', self.cls.generic_visit
+        # unbound methods have to be unwrapped in Python 2
+        method = getattr(method, '__func__', method)
+        profiled = self[node_class] = self.profile.wrap(name, method)
+        return profiled
+
+
+# Structural fingerprints
+#
+# The digest of a tree is the MD5 of a stream of tokens: the class name of each
+# node followed by its fields in order, a list as its length and items, None
+# and any other value as its repr, which never contains the NUL byte that the
+# tokens are joined with.  Each statement is hashed on its own, and stands for
+# itself in the stream of the statement or module holding it, so the digests
+# of statements can be memoized and reused.
+
+# include_attributes -> node class -> class name, the names of its fields
+# (then attributes) backwards, and a getter of their values
+_fingerprint_classes = {False: {}, True: {}}
+
+def _fingerprint_class(cls, include_attributes):
+    fields = cls._fields
+    if include_attributes:
+        fields += cls._attributes
+    fields = fields[::-1]
+    # gets the values of all the fields in one call, in a tuple unless there
+    # is a single one
+    getter = attrgetter(*fields) if fields else None
+    return cls.__name__, fields, getter
+
+def fingerprint(node, memo=None, include_attributes=False):
+    """Return a 16 byte digest of the structure of the tree `node`: its node
+    types, fields and constants, and with `include_attributes` the line and
+    column numbers as well.
+
+    Digests are stable between runs and processes of a Python version.  Pass
+    the same `memo` dict to calls on trees that share statements to hash each
+    of them only once, e.g. each statement of a module and then the module.
+    It keeps the statements alive, so their ids aren't reused, and is only
+    valid as long as they aren't modified, and for one value of
+    `include_attributes`.
+    """
+    if memo is None:
+        memo = {}
+    done = memo.get(id(node))
+    if done is not None:
+        return done[1]
+
+    # the statements being hashed, the outermost first: each with its tokens
+    # and the values left to add to them, last first
+    frames = [(node, [], [node])]
+    classes = _fingerprint_classes[include_attributes]
+    while True:
+        unit, tokens, work = frames[-1]
+        add = tokens.append
+        push = work.append
+        pop = work.pop
+        while work:
+            value = pop()
+            cls = value.__class__
+            if cls is str:
+                add(repr(value))
+            elif cls is Name and not include_attributes:
+                # the most common node by far
+                add('Name')
+                add(repr(value.id))
+                add(value.ctx.__class__.__name__)
+            elif isinstance(value, AST):
+                if value is not unit and isinstance(value, stmt):
+                    done = memo.get(id(value))
+                    if done is None:
+                        # hash the statement first, then come back to it
+                        push(value)
+                        frames.append((value, [], [value]))
+                        break
+                    add(done[2])
+                    continue
+                try:
+                    name, fields, getter = classes[cls]
+                except KeyError:
+                    name, fields, getter = classes[cls] = _fingerprint_class(
+                        cls, include_attributes)
+                add(name)
+                if getter is not None:
+                    try:
+                        if len(fields) == 1:
+                            push(getter(value))
+                        else:
+                            work.extend(getter(value))
+                    except AttributeError:
+                        # fields that were never set
+                        for field in fields:
+                            push(getattr(value, field, None))
+            elif cls is list:
+                add('[%d' % len(value))
+                work.extend(value[::-1])
+            else:
+                add(repr(value))
+        else:
+            digest = md5('\x00'.join(tokens).encode('utf-8'))
+            memo[id(unit)] = done = (unit, digest.digest(), '#' + digest.hexdigest())
+            frames.pop()
+            if not frames:
+                return done[1]
 
 
 class SourceGenerator(NodeVisitor):
@@ -136,15 +352,21 @@ class SourceGenerator(NodeVisitor):
     BLOCK_NODES = (If, For, While, With, Try, TryExcept, TryFinally,
                    FunctionDef, ClassDef)
 
-    def __init__(self, indent_with, add_line_information=False, correct_line_numbers=False, line_number=1):
+    def __init__(self, indent_with, add_line_information=False, correct_line_numbers=False, line_number=1, source_map=False):
         self.result = []
         self.indent_with = indent_with
+        # indent_strings[n] is indent_with * n, grown as blocks get deeper
+        self.indent_strings = ['', indent_with]
         self.add_line_information = add_line_information
         self.indentation = 0
         self.new_lines = 0
 
-        # precedence_stack: what precedence level are we on, could we safely newline before and is this operator left-to-right
-        self.precedence_stack = [[0, False, None]]
+        # precedence: what precedence level the expression being visited is expected to have.
+        # Operators save it in a local and restore it when they're done, only brackets push it on
+        # precedence_stack. newline_stack: could we safely newline before the innermost bracket
+        self.precedence = 0
+        self.precedence_stack = []
+        self.newline_stack = []
 
         self.correct_line_numbers = correct_line_numbers
         # The current line number we *think* we are on. As in it's most likely
@@ -160,10 +382,31 @@ class SourceGenerator(NodeVisitor):
         # reset by a call to self.newline, set by the first call to write() afterwards
         # determines if we have to print the newlines and indent
         self.indented = False
-        # the amount of newlines to be printed
-        self.newlines = 0
         # force the printing of a proper newline (and not a semicolon)
         self.force_newline = False
+        # set when new_lines or indented have changed since the last write, so
+        # that the writes in the middle of a line skip straight to appending
+        self.pending = False
+        # (count, indentation, escaped) -> newlines and indentation, see line_break
+        self.line_breaks = {}
+
+        # original line number of every rendered line, filled in as newlines
+        # are written. lineno is the line number of the current statement
+        self.source_map = array('i', [0]) if source_map else None
+        self.lineno = 0
+
+        self.dispatch = _dispatch_tables.setdefault(self.__class__, {})
+
+    def visit(self, node):
+        # the visit_* method for each node class is looked up once, rather
+        # than building its name and a bound method for every node
+        try:
+            method = self.dispatch[node.__class__]
+        except KeyError:
+            cls = self.__class__
+            method = getattr(cls, 'visit_' + node.__class__.__name__, cls.generic_visit)
+            self.dispatch[node.__class__] = method
+        return method(self, node)
 
     def process(self, node):
         self.visit(node)
@@ -173,38 +416,33 @@ class SourceGenerator(NodeVisitor):
 
     # Precedence management
 
-    def prec_start(self, value, ltr=None):
-        newline = self.can_newline
-        if value < self.precedence_stack[-1][0]:
+    def prec_start(self, value):
+        # open a parenthesis if an expression of precedence `value` binds less
+        # tightly than expected here. Returns the expected precedence, which
+        # the caller hands back to prec_end once it has visited its operands
+        outer = self.precedence
+        if value < outer:
+            self.newline_stack.append(self.can_newline)
             self.write('(')
             self.can_newline = True
-        if ltr == False:
-            value += 1
-        self.precedence_stack.append([value, newline, ltr])
-
-    def prec_middle(self, level=None):
-        if level is not None:
-            self.precedence_stack[-1][0] = level
-        elif self.precedence_stack[-1][2]:
-            self.precedence_stack[-1][0] += 1
-        elif self.precedence_stack[-1][2] is False:
-            self.precedence_stack[-1][0] -= 1
-
-    def prec_end(self):
-        precedence, newline, ltr = self.precedence_stack.pop()
-        if ltr:
-            precedence -= 1
-        if precedence < self.precedence_stack[-1][0]:
+        return outer
+
+    def prec_end(self, value, outer):
+        self.precedence = outer
+        if value < outer:
             self.write(')')
-            self.can_newline = newline
+            self.can_newline = self.newline_stack.pop()
 
     def paren_start(self, symbol='('):
-        self.precedence_stack.append([0, self.can_newline, None])
+        self.precedence_stack.append(self.precedence)
+        self.precedence = 0
+        self.newline_stack.append(self.can_newline)
         self.write(symbol)
         self.can_newline = True
 
     def paren_end(self, symbol=')'):
-        _, self.can_newline, _ = self.precedence_stack.pop()
+        self.precedence = self.precedence_stack.pop()
+        self.can_newline = self.newline_stack.pop()
         self.write(symbol)
 
     # convenience functions
@@ -213,61 +451,96 @@ class SourceGenerator(NodeVisitor):
         # ignore empty writes
         if not x:
             return
+        if self.pending:
+            self.flush()
+        self.result.append(x)
 
+    def flush(self):
         # Before we write, we must check if newlines have been queued.
         # If this is the case, we have to handle them properly
-        if self.correct_line_numbers:
-            if not self.indented:
-                self.new_lines = max(self.new_lines, 1 if self.force_newline else 0)
-                self.force_newline = False
+        self.pending = False
+        new_lines = self.new_lines
+        self.new_lines = 0
+        if not self.correct_line_numbers:
+            # normal behaviour
+            if new_lines:
+                self.result.append(self.line_break(new_lines, self.indentation))
+                if self.source_map is not None:
+                    self.mark_lines(new_lines)
+            return
 
-                if self.new_lines:
-                    # we have new lines to print
-                    if self.after_colon == 2:
-                        self.result.append(';'+'\\\n' * self.new_lines)
-                    else:
-                        self.after_colon = 0
-                        self.result.append('\n' * self.new_lines)
-                    self.result.append(self.indent_with * self.indentation)
-                elif self.after_colon == 1:
-                    # we're directly after a block-having statement and can write on the same line
-                    self.after_colon = 2
-                    self.result.append(' ')
-                elif self.result:
-                    # we're after any statement. or at the start of the file
-                    self.result.append(self.SEMICOLON)
-                self.indented = True
-            elif self.new_lines > 0:
-                if self.can_newline:
-                    self.result.append('\n' * self.new_lines)
-                    self.result.append(self.indent_with * (self.indentation + 1))
+        # the newlines actually written, whatever the gap asked for
+        lines = new_lines if new_lines > 0 else 0
+        if not self.indented:
+            self.indented = True
+            if self.force_newline:
+                self.force_newline = False
+                if not lines and self.result:
+                    # blocks start on a line of their own
+                    lines = 1
+            if lines:
+                # we have new lines to print
+                if self.after_colon == 2:
+                    self.result.append(';')
+                    self.result.append(self.line_break(lines, self.indentation, True))
                 else:
-                    self.result.append('\\\n' * self.new_lines)
-                    self.result.append(self.indent_with * (self.indentation + 1))
-            self.new_lines = 0
-
-
-        elif self.new_lines:
-            # normal behaviour
-            self.result.append('\n' * self.new_lines)
-            self.result.append(self.indent_with * self.indentation)
-            self.new_lines = 0
-        self.result.append(x)
+                    self.after_colon = 0
+                    self.result.append(self.line_break(lines, self.indentation))
+                if self.source_map is not None:
+                    self.mark_lines(lines)
+            elif self.after_colon == 1:
+                # we're directly after a block-having statement and can write on the same line
+                self.after_colon = 2
+                self.result.append(' ')
+            elif self.result:
+                # we're after any statement. or at the start of the file
+                self.result.append(self.SEMICOLON)
+        elif lines:
+            # inside an expression: continuation lines are indented one level further
+            self.result.append(self.line_break(
+                lines, self.indentation + 1, not self.can_newline))
+            if self.source_map is not None:
+                self.mark_lines(lines)
+        # when the code couldn't land on its line, measure the next gaps from
+        # where it did land, so that one forced newline doesn't shift the rest
+        self.line_number += lines - new_lines
+
+    def line_break(self, count, indentation, escaped=False):
+        # the same few runs of newlines and indentation are written over and
+        # over, so only build each of them once per generator
+        key = (count, indentation, escaped)
+        try:
+            return self.line_breaks[key]
+        except KeyError:
+            text = ('\\\n' if escaped else '\n') * count + self.indent_strings[indentation]
+            self.line_breaks[key] = text
+            return text
+
+    def mark_lines(self, count):
+        # every newline starts a rendered line belonging to the current statement
+        self.source_map.extend([self.lineno] * count)
 
     def newline(self, node=None, extra=0, force=False):
+        if node is not None and self.source_map is not None:
+            self.lineno = node.lineno
+            if not self.result:
+                self.source_map[0] = self.lineno
         if not self.correct_line_numbers:
             self.new_lines = max(self.new_lines, 1 + extra)
             if not self.result:
                 self.new_lines = 0
+            self.pending = self.new_lines > 0
             if node is not None and self.add_line_information:
                 self.write('# line: %s' % node.lineno)
                 self.new_lines = 1
+                self.pending = True
         else:
             if extra:
                 #Ignore extra
                 return
 
             self.indented = False
+            self.pending = True
 
             if node is None:
                 # else/finally statement. insert one true newline. body is implicit
@@ -287,13 +560,19 @@ class SourceGenerator(NodeVisitor):
                 self.line_number = node.lineno
 
     def maybe_break(self, node):
-        if self.correct_line_numbers:
+        # only ever move forward: expressions located before the current line
+        # (rewritten asserts are full of them) stay where they are
+        if self.correct_line_numbers and node.lineno > self.line_number:
             self.new_lines += node.lineno - self.line_number
             self.line_number = node.lineno
+            self.pending = True
 
     def body(self, statements):
         self.force_newline = any(isinstance(i, self.BLOCK_NODES) for i in statements)
         self.indentation += 1
+        if self.indentation + 1 >= len(self.indent_strings):
+            # line continuations are indented one level further
+            self.indent_strings.append(self.indent_with * len(self.indent_strings))
         self.after_colon = 1
         for stmt in statements:
             self.visit(stmt)
@@ -364,28 +643,30 @@ class SourceGenerator(NodeVisitor):
 
     def visit_Await(self, node):
         self.maybe_break(node)
-        self.prec_start(16, True)
-        self.prec_middle()
+        outer = self.prec_start(16)
+        self.precedence = 17
         self.write('await ')
         self.visit(node.value)
-        self.prec_end()
+        self.prec_end(16, outer)
 
     def visit_ImportFrom(self, node):
         self.newline(node)
         self.write('from ')
         self.write('%s%s' % ('.' * node.level, node.module or ''))
         self.write(' import ')
-        sep = Sep(self.COMMA)
+        sep = ''
         for item in node.names:
-            self.write(sep())
+            self.write(sep)
+            sep = self.COMMA
             self.visit(item)
 
     def visit_Import(self, node):
         self.newline(node)
         self.write('import ')
-        sep = Sep(self.COMMA)
+        sep = ''
         for item in node.names:
-            self.write(sep())
+            self.write(sep)
+            sep = self.COMMA
             self.visit(item)
 
     def visit_Exec(self, node):
@@ -406,11 +687,11 @@ class SourceGenerator(NodeVisitor):
     def visit_AsyncFunctionDef(self, node):
         self.visit_FunctionDef(node, True)
 
-    def visit_FunctionDef(self, node, async=False):
+    def visit_FunctionDef(self, node, is_async=False):
         self.newline(extra=1)
         # first decorator line number will be used
         self.decorators(node)
-        if async:
+        if is_async:
             self.write('async ')
         self.write('def ')
         self.write(node.name)
@@ -424,17 +705,19 @@ class SourceGenerator(NodeVisitor):
         self.body(node.body)
 
     def visit_arguments(self, node):
-        sep = Sep(self.COMMA)
+        sep = ''
         padding = [None] * (len(node.args) - len(node.defaults))
         if hasattr(node, 'kwonlyargs'):
             for arg, default in zip(node.args, padding + node.defaults):
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.visit(arg)
                 if default is not None:
                     self.write('=')
                     self.visit(default)
             if node.vararg is not None:
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 if hasattr(node, 'varargannotation'):
                     if node.varargannotation is None:
                         self.write('*' + node.vararg)
@@ -448,16 +731,19 @@ class SourceGenerator(NodeVisitor):
                     self.write('*')
                     self.visit(node.vararg)
             elif node.kwonlyargs:
-                self.write(sep() + '*')
+                self.write(sep + '*')
+                sep = self.COMMA
 
             for arg, default in zip(node.kwonlyargs, node.kw_defaults):
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.visit(arg)
                 if default is not None:
                     self.write('=')
                     self.visit(default)
             if node.kwarg is not None:
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 if hasattr(node, 'kwargannotation'):
                     if node.kwargannotation is None:
                         self.write('**' + node.kwarg)
@@ -472,16 +758,19 @@ class SourceGenerator(NodeVisitor):
                     self.visit(node.kwarg)
         else:
             for arg, default in zip(node.args, padding + node.defaults):
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.visit(arg)
                 if default is not None:
                     self.write('=')
                     self.visit(default)
             if node.vararg is not None:
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.write('*' + node.vararg)
             if node.kwarg is not None:
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.write('**' + node.kwarg)
 
     def visit_arg(self, node):
@@ -509,25 +798,29 @@ class SourceGenerator(NodeVisitor):
         if (node.bases or (hasattr(node, 'keywords') and node.keywords) or
                 (hasattr(node, 'starargs') and (node.starargs or node.kwargs))):
             self.paren_start()
-            sep = Sep(self.COMMA)
+            sep = ''
 
             for base in node.bases:
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.visit(base)
             # XXX: the if here is used to keep this module compatible
             #      with python 2.6.
             if hasattr(node, 'keywords'):
                 for keyword in node.keywords:
-                    self.write(sep())
+                    self.write(sep)
+                    sep = self.COMMA
                     self.visit(keyword)
                 if hasattr(node, 'starargs'):
                     if node.starargs is not None:
-                        self.write(sep())
+                        self.write(sep)
+                        sep = self.COMMA
                         self.maybe_break(node.starargs)
                         self.write('*')
                         self.visit(node.starargs)
                     if node.kwargs is not None:
-                        self.write(sep())
+                        self.write(sep)
+                        sep = self.COMMA
                         self.maybe_break(node.kwargs)
                         self.write('**')
                         self.visit(node.kwargs)
@@ -559,9 +852,9 @@ class SourceGenerator(NodeVisitor):
     def visit_AsyncFor(self, node):
         self.visit_For(node, True)
 
-    def visit_For(self, node, async=False):
+    def visit_For(self, node, is_async=False):
         self.newline(node, force=True)
-        if async:
+        if is_async:
             self.write('async ')
         self.write('for ')
         self.visit_bare(node.target)
@@ -580,16 +873,17 @@ class SourceGenerator(NodeVisitor):
     def visit_AsyncWith(self, node):
         self.visit_With(node, True)
 
-    def visit_With(self, node, async=False):
+    def visit_With(self, node, is_async=False):
         self.newline(node, force=True)
-        if async:
+        if is_async:
             self.write('async ')
         self.write('with ')
 
         if hasattr(node, 'items'):
-            sep = Sep(self.COMMA)
+            sep = ''
             for item in node.items:
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.visit_withitem(item)
         else:
             # in python 2, similarly to the elif statement, multiple nested context managers
@@ -616,13 +910,14 @@ class SourceGenerator(NodeVisitor):
         # XXX: python 2 only
         self.newline(node)
         self.write('print ')
-        sep = Sep(self.COMMA)
+        sep = ''
         if node.dest is not None:
             self.write(' >> ')
             self.visit(node.dest)
-            sep()
+            sep = self.COMMA
         for value in node.values:
-            self.write(sep())
+            self.write(sep)
+            sep = self.COMMA
             self.visit(value)
         if not node.nl:
             self.write(',')
@@ -630,9 +925,10 @@ class SourceGenerator(NodeVisitor):
     def visit_Delete(self, node):
         self.newline(node)
         self.write('del ')
-        sep = Sep(self.COMMA)
+        sep = ''
         for target in node.targets:
-            self.write(sep())
+            self.write(sep)
+            sep = self.COMMA
             self.visit(target)
 
     def visit_Try(self, node):
@@ -738,9 +1034,11 @@ class SourceGenerator(NodeVisitor):
             self.visit(node.value)
             self.paren_end()
         else:
-            self.prec_start(17)
+            # nothing binds more tightly, so this never needs a parenthesis
+            outer = self.precedence
+            self.precedence = 17
             self.visit(node.value)
-            self.prec_end()
+            self.precedence = outer
         self.write('.' + node.attr)
 
     def visit_Call(self, node):
@@ -751,9 +1049,11 @@ class SourceGenerator(NodeVisitor):
             self.visit_Num(node.func)
             self.paren_end()
         else:
-            self.prec_start(17)
+            # nothing binds more tightly, so this never needs a parenthesis
+            outer = self.precedence
+            self.precedence = 17
             self.visit(node.func)
-            self.prec_end()
+            self.precedence = outer
         # special case generator expressions as only argument
         if (len(node.args) == 1 and isinstance(node.args[0], GeneratorExp) and
                 not node.keywords and hasattr(node, 'starargs') and
@@ -762,22 +1062,26 @@ class SourceGenerator(NodeVisitor):
             return
 
         self.paren_start()
-        sep = Sep(self.COMMA)
+        sep = ''
         for arg in node.args:
-            self.write(sep())
+            self.write(sep)
+            sep = self.COMMA
             self.maybe_break(arg)
             self.visit(arg)
         for keyword in node.keywords:
-            self.write(sep())
+            self.write(sep)
+            sep = self.COMMA
             self.visit(keyword)
         if hasattr(node, 'starargs'):
             if node.starargs is not None:
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.maybe_break(node.starargs)
                 self.write('*')
                 self.visit(node.starargs)
             if node.kwargs is not None:
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.maybe_break(node.kwargs)
                 self.write('**')
                 self.visit(node.kwargs)
@@ -791,16 +1095,38 @@ class SourceGenerator(NodeVisitor):
         self.maybe_break(node)
         self.write(repr(node.value))
 
+    def visit_Constant(self, node):
+        # Python 3.8+ parses every literal into a Constant
+        value = node.value
+        if value is ELLIPSIS:
+            self.visit_Ellipsis(node)
+        elif value is None or value is True or value is False:
+            self.visit_NameConstant(node)
+        else:
+            self.maybe_break(node)
+            if isinstance(value, bytes):
+                self.write_string(value, True)
+            elif isinstance(value, str):
+                self.write_string(value)
+            elif isinstance(value, (int, float, complex)):
+                self.write_number(value)
+            else:
+                # tuples and frozensets folded by an optimizer
+                self.write(repr(value))
+
     def visit_Str(self, node, frombytes=False):
         self.maybe_break(node)
+        self.write_string(node.s, frombytes)
+
+    def write_string(self, value, frombytes=False):
         if frombytes:
-            newline_count = node.s.count('\n'.encode('utf-8'))
+            newline_count = value.count(b'\n')
         else:
-            newline_count = node.s.count('\n')
+            newline_count = value.count('\n')
 
         # heuristic, expand when more than 1 newline and when at least 80%
         # of the characters aren't newlines
-        expand = newline_count > 1 and len(node.s) > 5 * newline_count
+        expand = newline_count > 1 and len(value) > 5 * newline_count
         if self.correct_line_numbers:
             # Also check if we have enougn newlines to expand in if we're going for correct line numbers
             if self.after_colon:
@@ -809,60 +1135,72 @@ class SourceGenerator(NodeVisitor):
             else:
                 expand = expand and self.new_lines >= newline_count
 
+        a = repr(value)
         if expand and (not self.correct_line_numbers or self.new_lines >= newline_count):
             if self.correct_line_numbers:
                 self.new_lines -= newline_count
 
-            a = repr(node.s)
             delimiter = a[-1]
-            header, content = a[:-1].split(delimiter, 1)
-            lines = []
-            chain = False
-            for i in content.split('\\n'):
-                if chain:
-                    i = lines.pop() + i
-                    chain = False
-                if (len(i) - len(i.rstrip('\\'))) % 2:
-                    i += '\\n'
-                    chain = True
-                lines.append(i)
-            assert newline_count + 1 == len(lines)
-            self.write(header)
+            start = a.index(delimiter)
+            content = a[start + 1:-1]
+            if '\\\\n' not in content:
+                # every \n in the repr is an escaped newline
+                content = '\n'.join(content.split('\\n'))
+            else:
+                # some are an escaped backslash followed by an n instead:
+                # only the ones after an even number of backslashes count
+                lines = []
+                chain = False
+                for i in content.split('\\n'):
+                    if chain:
+                        i = lines.pop() + i
+                        chain = False
+                    if (len(i) - len(i.rstrip('\\'))) % 2:
+                        i += '\\n'
+                        chain = True
+                    lines.append(i)
+                content = '\n'.join(lines)
+            self.write(a[:start])
             self.write(delimiter * 3)
-            self.write('\n'.join(lines))
+            self.write(content)
             self.write(delimiter * 3)
+            if self.source_map is not None:
+                self.mark_lines(newline_count)
         else:
-            self.write(repr(node.s))
+            self.write(a)
 
     def visit_Bytes(self, node):
         self.visit_Str(node, True)
 
     def visit_Num(self, node):
         self.maybe_break(node)
+        self.write_number(node.n)
 
-        negative = (node.n.imag or node.n.real) < 0 and not PY3
+    def write_number(self, n):
+        negative = (n.imag or n.real) < 0 and not PY3
         if negative:
-            self.prec_start(self.UNARYOP_SYMBOLS[USub][1])
+            outer = self.prec_start(self.UNARYOP_SYMBOLS[USub][1])
 
         # 1e999 and related friends are parsed into inf
-        if abs(node.n) == 1e999:
+        if abs(n) == 1e999:
             if negative:
                 self.write('-')
             self.write('1e999')
-            if node.n.imag:
+            if n.imag:
                 self.write('j')
         else:
-            self.write(repr(node.n))
+            self.write(repr(n))
 
         if negative:
-            self.prec_end()
+            self.prec_end(self.UNARYOP_SYMBOLS[USub][1], outer)
 
     def visit_Tuple(self, node, guard=True):
         if guard or not node.elts:
             self.paren_start()
-        sep = Sep(self.COMMA)
+        sep = ''
         for item in node.elts:
-            self.write(sep())
+            self.write(sep)
+            sep = self.COMMA
             self.visit(item)
         if len(node.elts) == 1:
             self.write(',')
@@ -873,9 +1211,10 @@ class SourceGenerator(NodeVisitor):
         def visit(self, node):
             self.maybe_break(node)
             self.paren_start(left)
-            sep = Sep(self.COMMA)
+            sep = ''
             for item in node.elts:
-                self.write(sep())
+                self.write(sep)
+                sep = self.COMMA
                 self.visit(item)
             self.paren_end(right)
         return visit
@@ -886,9 +1225,10 @@ class SourceGenerator(NodeVisitor):
     def visit_Dict(self, node):
         self.maybe_break(node)
         self.paren_start('{')
-        sep = Sep(self.COMMA)
+        sep = ''
         for key, value in zip(node.keys, node.values):
-            self.write(sep())
+            self.write(sep)
+            sep = self.COMMA
             self.visit(key)
             self.write(self.COLON)
             self.visit(value)
@@ -897,44 +1237,48 @@ class SourceGenerator(NodeVisitor):
     def visit_BinOp(self, node):
         self.maybe_break(node)
         symbol, precedence = self.BINOP_SYMBOLS[type(node.op)]
-        self.prec_start(precedence, type(node.op) != Pow)
+        outer = self.prec_start(precedence)
 
         # work around python's negative integer literal optimization
         if isinstance(node.op, Pow):
+            self.precedence = precedence + 1
             self.visit(node.left)
-            self.prec_middle(14)
+            self.precedence = 14
         else:
+            self.precedence = precedence
             self.visit(node.left)
-            self.prec_middle()
+            self.precedence = precedence + 1
         self.write(symbol)
         self.visit(node.right)
-        self.prec_end()
+        self.prec_end(precedence, outer)
 
     def visit_BoolOp(self, node):
         self.maybe_break(node)
         symbol, precedence = self.BOOLOP_SYMBOLS[type(node.op)]
-        self.prec_start(precedence, True)
-        self.prec_middle()
-        sep = Sep(symbol)
+        outer = self.prec_start(precedence)
+        self.precedence = precedence + 1
+        sep = ''
         for value in node.values:
-            self.write(sep())
+            self.write(sep)
+            sep = symbol
             self.visit(value)
-        self.prec_end()
+        self.prec_end(precedence, outer)
 
     def visit_Compare(self, node):
         self.maybe_break(node)
-        self.prec_start(7, True)
-        self.prec_middle()
+        outer = self.prec_start(7)
+        self.precedence = 8
         self.visit(node.left)
         for op, right in zip(node.ops, node.comparators):
             self.write(self.CMPOP_SYMBOLS[type(op)][0])
             self.visit(right)
-        self.prec_end()
+        self.prec_end(7, outer)
 
     def visit_UnaryOp(self, node):
         self.maybe_break(node)
         symbol, precedence = self.UNARYOP_SYMBOLS[type(node.op)]
-        self.prec_start(precedence)
+        outer = self.prec_start(precedence)
+        self.precedence = precedence
         self.write(symbol)
         # workaround: in python 2, an explicit USub node around a number literal
         # indicates the literal was surrounded by parenthesis
@@ -945,7 +1289,7 @@ class SourceGenerator(NodeVisitor):
             self.paren_end()
         else:
             self.visit(node.operand)
-        self.prec_end()
+        self.prec_end(precedence, outer)
 
     def visit_Subscript(self, node):
         self.maybe_break(node)
@@ -955,9 +1299,11 @@ class SourceGenerator(NodeVisitor):
             self.visit_Num(node.value)
             self.paren_end()
         else:
-            self.prec_start(17)
+            # nothing binds more tightly, so this never needs a parenthesis
+            outer = self.precedence
+            self.precedence = 17
             self.visit(node.value)
-            self.prec_end()
+            self.precedence = outer
         self.paren_start('[')
         self.visit(node.slice)
         self.paren_end(']')
@@ -1023,12 +1369,13 @@ class SourceGenerator(NodeVisitor):
 
     def visit_Lambda(self, node):
         self.maybe_break(node)
-        self.prec_start(2)
+        outer = self.prec_start(2)
+        self.precedence = 2
         self.write('lambda ')
         self.visit_arguments(node.args)
         self.write(self.COLON)
         self.visit(node.body)
-        self.prec_end()
+        self.prec_end(2, outer)
 
     def _generator_visit(left, right):
         def visit(self, node):
@@ -1056,14 +1403,15 @@ class SourceGenerator(NodeVisitor):
 
     def visit_IfExp(self, node):
         self.maybe_break(node)
-        self.prec_start(3, False)
+        outer = self.prec_start(3)
+        self.precedence = 4
         self.visit(node.body)
         self.write(' if ')
         self.visit(node.test)
-        self.prec_middle(2)
+        self.precedence = 2
         self.write(' else ')
         self.visit(node.orelse)
-        self.prec_end()
+        self.prec_end(3, outer)
 
     def visit_Starred(self, node):
         self.maybe_break(node)
@@ -1091,9 +1439,10 @@ class SourceGenerator(NodeVisitor):
         self.visit_bare(node.target)
         self.write(' in ')
         # workaround: lambda and ternary need to be within parenthesis here
-        self.prec_start(4)
+        outer = self.prec_start(4)
+        self.precedence = 4
         self.visit(node.iter)
-        self.prec_end()
+        self.prec_end(4, outer)
 
         for if_ in node.ifs:
             self.write(' if ')
@@ -1,11 +1,44 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import argparse
+import ast
+import binascii
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import marshal
+import os
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
+
+import pytest
+import _pytest.assertion.rewrite
 from _pytest.assertion.rewrite import rewrite_asserts
 from _pytest.monkeypatch import monkeypatch
 
+import ast_as_python_hooks
+from ast_as_python_cache import RenderCache
 import codegen
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from importlib.util import MAGIC_NUMBER
+    from _imp import _fix_co_filename
+except ImportError:
+    # Python 2
+    from imp import get_magic
+    MAGIC_NUMBER = get_magic()
+    _fix_co_filename = None
+
 
 def pytest_addoption(parser):
     group = parser.getgroup('ast-back-to-python')
@@ -16,29 +49,833 @@ def pytest_addoption(parser):
         default=False,
         help='Show how assertion rewriting recoded the AST.'
     )
+    group.addoption(
+        '--ast-as-python-sample',
+        action='store',
+        dest='ast_as_python_sample',
+        default=None,
+        type=parse_sample,
+        metavar='N|PCT%',
+        help='Only render a stable, hash-based sample of the rewritten '
+             'modules: at most N of them, or PCT%% of them.'
+    )
+    group.addoption(
+        '--ast-as-python-seed',
+        action='store',
+        dest='ast_as_python_seed',
+        default='0',
+        metavar='SEED',
+        help='Seed used to pick the --ast-as-python-sample modules.'
+    )
+    group.addoption(
+        '--ast-as-python-format',
+        action='store',
+        dest='ast_as_python_format',
+        default='text',
+        choices=['text', 'ndjson'],
+        help='Show the rewritten modules as text in the terminal summary '
+             '(default), or stream one JSON record per module to '
+             '--ast-as-python-output as it is rewritten.'
+    )
+    group.addoption(
+        '--ast-as-python-output',
+        action='store',
+        dest='ast_as_python_output',
+        default='ast-as-python.ndjson',
+        metavar='PATH',
+        help='Where to write the ndjson records '
+             '(default: ast-as-python.ndjson).'
+    )
+    group.addoption(
+        '--ast-as-python-target',
+        action='append',
+        dest='ast_as_python_targets',
+        default=[],
+        type=parse_target,
+        metavar='FILE:LINE',
+        help='Only show the code generated for the statement spanning LINE '
+             'of FILE. May be given more than once.'
+    )
+    group.addoption(
+        '--ast-as-python-workers',
+        action='store',
+        dest='ast_as_python_workers',
+        default=0,
+        type=int,
+        metavar='N',
+        help='Render modules on a pool of N threads instead of in the import '
+             'hook (default: 0). Scales on free-threaded Python builds.'
+    )
+    group.addoption(
+        '--ast-as-python-preserve-lines',
+        action='store_true',
+        dest='ast_as_python_preserve_lines',
+        default=False,
+        help='Render the code of each statement on its line in the original '
+             'module, joining statements with semicolons and backslashes, so '
+             'that it matches the line numbers of tracebacks.'
+    )
+    group.addoption(
+        '--ast-as-python-stats',
+        action='store_true',
+        dest='ast_as_python_stats',
+        default=False,
+        help='Count what rewriting adds to each module (asserts, temporaries, '
+             'failure branches, statements and nodes), and show totals, a '
+             'histogram and the top modules. Needs no rendering.'
+    )
+    group.addoption(
+        '--ast-as-python-stats-top',
+        action='store',
+        dest='ast_as_python_stats_top',
+        default=10,
+        type=int,
+        metavar='N',
+        help='How many of the most expanded modules --ast-as-python-stats '
+             'lists (default: 10).'
+    )
+    group.addoption(
+        '--ast-as-python-export',
+        action='store',
+        dest='ast_as_python_export',
+        default=None,
+        metavar='DIR',
+        help='Write each rewritten module to DIR as valid Python, along with '
+             'its compiled code for later runs with --ast-as-python-load.'
+    )
+    group.addoption(
+        '--ast-as-python-load',
+        action='store',
+        dest='ast_as_python_load',
+        default=None,
+        metavar='DIR',
+        help='Import the code of the modules exported to DIR instead of '
+             'rewriting them, when they were exported from the same source '
+             'by the same pytest and Python versions. Needs Python 3.'
+    )
+    group.addoption(
+        '--ast-as-python-cache',
+        action='store',
+        dest='ast_as_python_cache',
+        default=None,
+        metavar='DIR',
+        help='Keep rendered modules in DIR, and reuse them in later runs for '
+             'identical sources, rewritten by the same pytest and Python '
+             'versions. Safe to share between concurrent runs.'
+    )
+    group.addoption(
+        '--ast-as-python-cache-size',
+        action='store',
+        dest='ast_as_python_cache_size',
+        default='64M',
+        type=parse_size,
+        metavar='SIZE',
+        help='Evict the least recently used entries of --ast-as-python-cache '
+             'beyond SIZE bytes, with an optional K, M or G suffix '
+             '(default: 64M).'
+    )
+    group.addoption(
+        '--ast-as-python-no-store',
+        action='store_false',
+        dest='ast_as_python_store',
+        default=True,
+        help="Don't keep the rendered modules for the terminal summary, when "
+             "they are only wanted by pytest_ast_as_python_rendered hooks."
+    )
+    group.addoption(
+        '--ast-as-python-selected',
+        action='store_true',
+        dest='ast_as_python_selected',
+        default=False,
+        help='Wait for the end of collection, and only render the modules '
+             'with at least one selected test (after -k, -m, --lf, ...).'
+    )
+    group.addoption(
+        '--ast-as-python-profile',
+        action='store_true',
+        dest='ast_as_python_profile',
+        default=False,
+        help='Time the rendering of each kind of node, and show the totals '
+             'per visit_* method at the end of the session.'
+    )
+    group.addoption(
+        '--ast-as-python-memory',
+        action='store_true',
+        dest='ast_as_python_memory',
+        default=False,
+        help='Trace memory with tracemalloc, and report the peak of rewriting '
+             'and rendering each module, the size of the rendered output '
+             'kept and the high-water mark. Rendering is serialised while '
+             'measuring. Needs Python 3.9+.'
+    )
+    group.addoption(
+        '--ast-as-python-memory-output',
+        action='store',
+        dest='ast_as_python_memory_output',
+        default=None,
+        metavar='PATH',
+        help='Also write the --ast-as-python-memory report to PATH as JSON.'
+    )
+
+def pytest_addhooks(pluginmanager):
+    pluginmanager.add_hookspecs(ast_as_python_hooks)
 
 def pytest_configure(config):
     config._ast_as_python = AstAsPython()
     config.pluginmanager.register(config._ast_as_python)
 
-def make_replacement_rewrite_asserts(store):
-    def replacement_rewrite_asserts(tree):
-        rewrite_asserts(tree)
-        store.append(codegen.to_source(tree))
+def parse_sample(value):
+    """Parse ``N`` or ``PCT%`` into a ``(kind, amount)`` pair."""
+    try:
+        if value.endswith('%'):
+            percent = float(value[:-1])
+            if 0 <= percent <= 100:
+                return 'percent', percent
+        else:
+            count = int(value)
+            if count >= 0:
+                return 'count', count
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(
+        'expected a module count N or a percentage PCT%%, got %r' % value)
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+def parse_size(value):
+    """Parse ``N``, ``NK``, ``NM`` or ``NG`` into a number of bytes."""
+    multiplier = SIZE_SUFFIXES.get(value[-1:].upper())
+    digits = value[:-1] if multiplier else value
+    if not digits.isdigit():
+        raise argparse.ArgumentTypeError(
+            'expected a size N, NK, NM or NG, got %r' % value)
+    return int(digits) * (multiplier or 1)
+
+def parse_target(value):
+    """Parse ``FILE:LINE`` into an absolute path and a line number."""
+    path, _, line = value.rpartition(':')
+    if not path or not line.isdigit():
+        raise argparse.ArgumentTypeError(
+            'expected FILE:LINE, got %r' % value)
+    return normalize_path(path), int(line)
+
+def normalize_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+def item_path(item):
+    # pytest 7 added item.path, and later versions dropped item.fspath
+    path = getattr(item, 'path', None)
+    if path is None:
+        path = item.fspath
+    return normalize_path(str(path))
+
+def has_implementations(hook):
+    try:
+        return bool(hook.get_hookimpls())
+    except AttributeError:
+        # pluggy < 0.5
+        return bool(hook._nonwrappers or hook._wrappers)
+
+def find_path_arg(args):
+    """Pick the module path out of the arguments of ``_rewrite_test``.
+
+    Their order and types differ between pytest versions, but the path is
+    always a ``py.path.local`` or an ``os.PathLike``.
+    """
+    for arg in args:
+        if hasattr(arg, 'strpath') or hasattr(arg, '__fspath__'):
+            return arg
+    return None
+
+def find_module_path(args):
+    arg = find_path_arg(args)
+    if arg is None:
+        return None
+    if hasattr(arg, 'strpath'):
+        return arg.strpath
+    return arg.__fspath__()
+
+# rewrite_asserts is passed the source bytes from pytest 5 on
+REWRITE_TAKES_SOURCE = int(pytest.__version__.split('.')[0]) >= 5
+
+def find_source(args, kwargs):
+    """Pick the source bytes out of the arguments of ``rewrite_asserts``, or
+    return None if this pytest doesn't pass them."""
+    if not REWRITE_TAKES_SOURCE:
+        return None
+    if args:
+        return args[0]
+    return kwargs.get('source')
+
+def statement_line(tree, line):
+    """Return the first line of the innermost statement of `tree` spanning
+    `line`, or None if there isn't one.
+
+    Before Python 3.8 nodes have no end line, so a statement is taken to run
+    until the next one starts. From 3.8 on, only the statements made by
+    rewriting can lack one, and they are taken to fit on their first line.
+    """
+    has_ends = sys.version_info >= (3, 8)
+    first = None
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.stmt) or node.lineno > line:
+            continue
+        end = getattr(node, 'end_lineno', None)
+        if end is None and has_ends:
+            end = node.lineno
+        if end is not None and end < line:
+            continue
+        if first is None or node.lineno > first:
+            first = node.lineno
+    return first
+
+def make_replacement_rewrite_test(plugin, original):
+    def replacement_rewrite_test(*args, **kwargs):
+        # modules may be imported from several threads at once
+        path_arg = find_path_arg(args)
+        path = plugin.local.path = find_module_path(args)
+        exporter = plugin.exporter
+        try:
+            if exporter is not None and exporter.load_dir:
+                code = exporter.load(path)
+                if code is not None:
+                    return path_arg.stat(), code
+            result = original(*args, **kwargs)
+            if exporter is not None and exporter.export_dir and result[1]:
+                exporter.export_code(
+                    path, getattr(plugin.local, 'source_sha1', None), result[1])
+            return result
+        finally:
+            plugin.local.path = plugin.local.source_sha1 = None
+    return replacement_rewrite_test
+
+def make_replacement_rewrite_asserts(plugin):
+    def replacement_rewrite_asserts(tree, *args, **kwargs):
+        path = getattr(plugin.local, 'path', None)
+        exporter = plugin.exporter
+        memory = plugin.memory
+        stats = plugin.stats
+        if stats is not None:
+            original = count_original(tree)
+        if memory is not None:
+            before = memory.start()
+        start = timer()
+        try:
+            rewrite_asserts(tree, *args, **kwargs)
+        finally:
+            rewrite_time = timer() - start
+            if memory is not None:
+                rewrite_peak = memory.stop(before)
+        source = find_source(args, kwargs)
+        if exporter is not None and exporter.export_dir:
+            # for the export of the code, once pytest has compiled it
+            plugin.local.source_sha1 = hash_source(source, path)
+            exporter.export(tree, path, plugin.local.source_sha1)
+        nodes = None
+        if stats is not None:
+            rewritten = count_rewritten(tree)
+            stats.add(plugin.relative_name(path), original, rewritten)
+            nodes = rewritten[0]
+        if not plugin.show:
+            return
+        module = plugin.rewritten(tree, path, rewrite_time, source, nodes)
+        if memory is not None and module is not None:
+            memory.record(module.name, rewrite=rewrite_peak)
     return replacement_rewrite_asserts
 
+EXPORT_PREFIX = '_at_'
+
+def mangle_names(tree):
+    """Give the names made by rewriting (@py_assert1, @pytest_ar, ...) valid
+    identifiers, and return what `restore_names` needs to undo it."""
+    renamed = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id.startswith('@'):
+                renamed.append((node, 'id', node.id))
+                node.id = EXPORT_PREFIX + node.id[1:]
+        elif isinstance(node, ast.alias):
+            if node.asname is not None and node.asname.startswith('@'):
+                renamed.append((node, 'asname', node.asname))
+                node.asname = EXPORT_PREFIX + node.asname[1:]
+    return renamed
+
+def restore_names(renamed):
+    for node, attr, name in renamed:
+        setattr(node, attr, name)
+
+def hash_source(source, path):
+    """Return the SHA-1 of `source`, read from `path` if pytest didn't pass
+    it on, or None if there is neither."""
+    if source is None:
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            source = f.read()
+    return hashlib.sha1(source).hexdigest()
+
+def source_stamp(source_sha1):
+    """What the rewritten module depends on: pytest, the bytecode version of
+    Python and the source."""
+    return 'pytest %s, bytecode %s, source sha1 %s' % (
+        pytest.__version__, binascii.hexlify(MAGIC_NUMBER).decode('ascii'),
+        source_sha1)
+
+class Exporter(object):
+    """Exports rewritten modules as valid Python, and loads them back.
+
+    Each export is a pair of files.  The ``.py`` file is the rendered module,
+    after two comment lines: where it comes from, and its `source_stamp`.
+    Next to it, the code pytest compiled from the rewritten tree is dumped
+    with `marshal`, after the same stamp.  Loading takes that code as it is,
+    with its line numbers pointing into the test file, and skips parsing and
+    rewriting the source altogether.
+    """
+
+    CODE_SUFFIX = '.marshal'
+
+    def __init__(self, export_dir, load_dir, rootdir):
+        self.export_dir = export_dir
+        self.load_dir = load_dir
+        self.rootdir = rootdir
+        self.exported = 0
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def relative_path(self, path):
+        if path is None:
+            return None
+        relative = os.path.relpath(path, self.rootdir)
+        if relative.split(os.sep)[0] == os.pardir:
+            return None
+        return relative
+
+    def target(self, relative):
+        target = os.path.join(self.export_dir, relative)
+        if not os.path.isdir(os.path.dirname(target)):
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError:
+                # made by another thread or process in the meantime
+                pass
+        return target
+
+    def export(self, tree, path, source_sha1):
+        relative = self.relative_path(path)
+        if not relative:
+            return
+        # the tree is compiled by pytest once we return, rename in between
+        renamed = mangle_names(tree)
+        try:
+            source = codegen.to_source(tree)
+        finally:
+            restore_names(renamed)
+
+        header = [
+            '# pytest-ast-back-to-python export of %s' % relative.replace(os.sep, '/'),
+            '# ' + source_stamp(source_sha1),
+        ]
+        text = '\n'.join(header) + '\n' + source
+        if not isinstance(text, type(u'')):
+            text = text.decode('utf-8')
+        with io.open(self.target(relative), 'w', encoding='utf-8') as f:
+            f.write(text)
+        with self.lock:
+            self.exported += 1
+
+    def export_code(self, path, source_sha1, code):
+        relative = self.relative_path(path)
+        if not relative or source_sha1 is None:
+            return
+        with open(self.target(relative) + self.CODE_SUFFIX, 'wb') as f:
+            f.write(source_stamp(source_sha1).encode('ascii') + b'\n')
+            f.write(marshal.dumps(code))
+
+    def load(self, path):
+        """Return the exported code of `path`, or None if there is no export
+        of its current source."""
+        relative = self.relative_path(path)
+        if not relative:
+            return None
+        target = os.path.join(self.load_dir, relative) + self.CODE_SUFFIX
+        try:
+            with open(target, 'rb') as f:
+                data = f.read()
+            with open(path, 'rb') as f:
+                source_sha1 = hashlib.sha1(f.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+        stamp, _, dumped = data.partition(b'\n')
+        if stamp != source_stamp(source_sha1).encode('ascii'):
+            return None
+        try:
+            code = marshal.loads(dumped)
+        except (EOFError, ValueError, TypeError):
+            return None
+        # the export may have been made in another checkout
+        _fix_co_filename(code, path)
+        with self.lock:
+            self.loaded += 1
+        return code
+
+class RewrittenModule(object):
+    """A module whose asserts have been rewritten, on its way to the output."""
+
+    def __init__(self, name, path, tree, rewrite_time, source=None,
+                 nodes=None):
+        self.name = name
+        self.path = path
+        self.tree = tree
+        self.rewrite_time = rewrite_time
+        self.render_time = None
+        # the bytes pytest rewrote, when it passes them on
+        self.source = source
+        # the nodes of the tree, when --ast-as-python-stats counted them
+        self.nodes = nodes
+        self._source_sha1 = None
+
+    @property
+    def source_sha1(self):
+        """The SHA-1 of the source of the module, computed on first use.
+        The file is only read again if pytest didn't pass the source on."""
+        if self._source_sha1 is None:
+            self._source_sha1 = hash_source(self.source, self.path)
+        return self._source_sha1
+
+class NdjsonWriter(object):
+    """Streams one JSON record per rendered module to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, module, source, source_map):
+        if not isinstance(source, type(u'')):
+            # a byte string from Python 2's codegen
+            source = source.decode('utf-8')
+        rendered = source.encode('utf-8')
+        nodes = module.nodes
+        if nodes is None:
+            nodes = sum(1 for _ in ast.walk(module.tree))
+        record = {
+            'path': module.name,
+            'source_sha1': module.source_sha1,
+            'nodes': nodes,
+            'rewrite_time': module.rewrite_time,
+            'render_time': module.render_time,
+            'size': len(rendered),
+            'source': source,
+            'source_map': list(source_map),
+        }
+        line = json.dumps(record, sort_keys=True).encode('utf-8') + b'\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.count += 1
+
+    def close(self):
+        self.file.close()
+
+class MemoryTracker(object):
+    """Measures the peak memory of each step of the pipeline with tracemalloc.
+
+    Peaks are process-wide, so steps are measured one at a time: `start`
+    takes a lock that `stop` releases.  The high-water mark also covers the
+    time between steps, like collection and running the tests.
+    """
+
+    def __init__(self):
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+        self.lock = threading.Lock()
+        self.high_water = 0
+        # module name -> {'rewrite': bytes, 'render': bytes}, in rewrite order
+        self.modules = {}
+        self.names = []
+
+    def start(self):
+        """Start measuring a step, return what to pass to `stop`."""
+        self.lock.acquire()
+        current, peak = tracemalloc.get_traced_memory()
+        self.high_water = max(self.high_water, peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def stop(self, before):
+        """Return the peak memory used by the step above what was in use
+        when it started."""
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            self.high_water = max(self.high_water, peak)
+            return peak - before
+        finally:
+            self.lock.release()
+
+    def record(self, name, **peaks):
+        with self.lock:
+            if name not in self.modules:
+                self.modules[name] = {'rewrite': None, 'render': None}
+                self.names.append(name)
+            self.modules[name].update(peaks)
+
+    def report(self, store):
+        with self.lock:
+            _, peak = tracemalloc.get_traced_memory()
+            self.high_water = max(self.high_water, peak)
+            return {
+                'modules': [
+                    dict(self.modules[name], path=name) for name in self.names
+                ],
+                'store_size': store_size(store),
+                'store_entries': len(store),
+                'high_water': self.high_water,
+            }
+
+    def close(self):
+        if self.started:
+            tracemalloc.stop()
+
+def store_size(store):
+    """Return the bytes held by the store list, its entries and their
+    strings."""
+    size = sys.getsizeof(store)
+    for entry in store:
+        size += sys.getsizeof(entry)
+        size += sum(sys.getsizeof(item) for item in entry if item is not None)
+    return size
+
+def format_kib(size):
+    if size is None:
+        return '-'
+    return '%.1f KiB' % (size / 1024.0)
+
+class Sampler(object):
+    """Picks a stable subset of modules from a hash of their path.
+
+    The same seed always selects the same modules, so that the output of
+    repeated runs can be compared.  A percentage is decided as each module is
+    rewritten; a count keeps the trees with the N lowest scores and renders
+    them once the session is over.
+    """
+
+    def __init__(self, sample, seed):
+        self.kind, self.amount = sample
+        self.seed = seed
+        self.seen = 0
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def score(self, name):
+        key = ('%s:%s' % (self.seed, name)).encode('utf-8')
+        return int(hashlib.sha1(key).hexdigest()[:13], 16) / float(16 ** 13)
+
+    def offer(self, module):
+        """Return True if the module should be rendered right away.
+
+        In count mode the module is kept until `selected` is called instead.
+        """
+        score = self.score(module.name)
+        with self.lock:
+            self.seen += 1
+            if self.kind == 'percent':
+                return score * 100 < self.amount
+
+            if self.amount:
+                # max-heap on the score, so the worst candidate is at the top
+                entry = (-score, next(self.counter), module)
+                if len(self.heap) < self.amount:
+                    heapq.heappush(self.heap, entry)
+                else:
+                    heapq.heappushpop(self.heap, entry)
+            return False
+
+    def selected(self):
+        """Return the kept modules, sorted by name."""
+        modules = [module for _, _, module in self.heap]
+        return sorted(modules, key=lambda module: module.name)
+
+def is_rewrite_name(node, prefix):
+    return isinstance(node, ast.Name) and node.id.startswith(prefix)
+
+def is_none(node):
+    # a Name on Python 2, NameConstant then Constant on Python 3
+    return getattr(node, 'value', 0) is None or getattr(node, 'id', None) == 'None'
+
+def count_original(tree):
+    """Return the nodes, statements and asserts of a tree about to be
+    rewritten."""
+    nodes = statements = asserts = 0
+    for node in ast.walk(tree):
+        nodes += 1
+        if isinstance(node, ast.stmt):
+            statements += 1
+            if isinstance(node, ast.Assert):
+                asserts += 1
+    return nodes, statements, asserts
+
+def count_rewritten(tree):
+    """Return the nodes, statements, ``@py_assert`` temporaries and branches
+    building a ``@py_format`` failure message of a rewritten tree."""
+    nodes = statements = temporaries = branches = 0
+    for node in ast.walk(tree):
+        nodes += 1
+        if not isinstance(node, ast.stmt):
+            continue
+        statements += 1
+        if isinstance(node, ast.Assign):
+            # not counting the "@py_assert1 = @py_assert2 = None" clean ups
+            if (is_rewrite_name(node.targets[0], '@py_assert') and
+                    not is_none(node.value)):
+                temporaries += 1
+        elif isinstance(node, ast.If):
+            for child in node.body:
+                if (isinstance(child, ast.Assign) and
+                        is_rewrite_name(child.targets[0], '@py_format')):
+                    branches += 1
+                    break
+    return nodes, statements, temporaries, branches
+
+class RewriteStats(object):
+    """Adds up what rewriting does to each module, as modules are rewritten.
+
+    Only a fixed set of counters is kept, plus the `top` most expanded
+    modules, so the memory used doesn't grow with the size of the suite.
+    Modules are ranked by the nodes that rewriting added to them.
+    """
+
+    # lower bounds of the buckets of the node expansion histogram
+    BUCKETS = (1, 1.25, 1.5, 2, 3, 5)
+    BAR_WIDTH = 40
+
+    def __init__(self, top):
+        self.top = top
+        self.lock = threading.Lock()
+        self.modules = 0
+        self.asserts = 0
+        self.temporaries = 0
+        self.branches = 0
+        self.nodes = [0, 0]
+        self.statements = [0, 0]
+        self.histogram = [0] * len(self.BUCKETS)
+        # (added nodes, name, asserts, node ratio), the smallest first
+        self.heap = []
+
+    def add(self, name, original, rewritten):
+        nodes, statements, asserts = original
+        new_nodes, new_statements, temporaries, branches = rewritten
+        ratio = new_nodes / float(nodes)
+        bucket = 0
+        while bucket + 1 < len(self.BUCKETS) and ratio >= self.BUCKETS[bucket + 1]:
+            bucket += 1
+        entry = (new_nodes - nodes, name, asserts, ratio)
+        with self.lock:
+            self.modules += 1
+            self.asserts += asserts
+            self.temporaries += temporaries
+            self.branches += branches
+            self.nodes[0] += nodes
+            self.nodes[1] += new_nodes
+            self.statements[0] += statements
+            self.statements[1] += new_statements
+            self.histogram[bucket] += 1
+            if len(self.heap) < self.top:
+                heapq.heappush(self.heap, entry)
+            elif self.heap and entry > self.heap[0]:
+                heapq.heapreplace(self.heap, entry)
+
+    def lines(self):
+        """The report, as lines of text."""
+        yield 'pytest %s rewrote %d asserts in %d modules' % (
+            pytest.__version__, self.asserts, self.modules)
+        yield '%d @py_assert temporaries, %d @py_format branches' % (
+            self.temporaries, self.branches)
+        for label, (before, after) in (
+                ('statements', self.statements), ('nodes', self.nodes)):
+            yield '%s: %d -> %d (x%.2f)' % (
+                label, before, after, after / float(before or 1))
+
+        yield ''
+        yield 'node expansion per module:'
+        most = max(self.histogram) or 1
+        for n, count in enumerate(self.histogram):
+            if n + 1 < len(self.BUCKETS):
+                label = 'x%s-x%s' % (self.BUCKETS[n], self.BUCKETS[n + 1])
+            else:
+                label = 'x%s+' % self.BUCKETS[n]
+            bar = '#' * int(round(self.BAR_WIDTH * count / float(most)))
+            yield ('%11s %6d %s' % (label, count, bar)).rstrip()
+
+        if self.heap:
+            yield ''
+            yield 'most expanded modules:'
+            yield '%11s %7s %7s  %s' % ('added nodes', 'ratio', 'asserts', 'module')
+            for added, name, asserts, ratio in sorted(self.heap, reverse=True):
+                yield '%11d %7s %7d  %s' % (added, 'x%.2f' % ratio, asserts, name)
+
 class AstAsPython(object):
     def __init__(self):
         self.store = []
+        self.lock = threading.Lock()
+        # the path of the module being rewritten, per importing thread
+        self.local = threading.local()
+        self.pool = None
+        self.pending = []
+        self.sampler = None
+        self.rootdir = None
+        self.ndjson = None
+        self.targets = None
+        # source SHA-1 -> name of the first module rendered with that source,
+        # and that name -> names of the identical modules seen after it
+        self.unique = {}
+        self.aliases = {}
+        self.profile = None
+        self.memory = None
+        self.memory_output = None
+        # with --ast-as-python-selected: the modules rewritten during
+        # collection, then once it is over, the paths of the selected items
+        self.deferred = None
+        self.selected = None
+        self.keep = True
+        self.rendered_hook = None
+        self.show = False
+        self.exporter = None
+        self.cache = None
+        self.preserve_lines = False
+        self.stats = None
 
     def pytest_configure(self, config):
-        if not config.getoption('ast_as_python'):
+        self.show = config.getoption('ast_as_python')
+        export_dir = config.getoption('ast_as_python_export')
+        load_dir = config.getoption('ast_as_python_load')
+        stats = config.getoption('ast_as_python_stats')
+        if not (self.show or export_dir or load_dir or stats):
             return
 
+        self.rootdir = str(config.rootdir)
+        if load_dir and _fix_co_filename is None:
+            raise pytest.UsageError('--ast-as-python-load needs Python 3')
+        if export_dir or load_dir:
+            self.exporter = Exporter(export_dir, load_dir, self.rootdir)
+        if stats:
+            self.stats = RewriteStats(config.getoption('ast_as_python_stats_top'))
+        if self.show:
+            self.configure_output(config)
+
         mp = monkeypatch()
         mp.setattr(
             '_pytest.assertion.rewrite.rewrite_asserts',
-            make_replacement_rewrite_asserts(self.store))
+            make_replacement_rewrite_asserts(self))
+
+        # rewrite_asserts isn't told which file it is rewriting, so capture
+        # the path on the way in
+        mp.setattr(
+            '_pytest.assertion.rewrite._rewrite_test',
+            make_replacement_rewrite_test(
+                self, _pytest.assertion.rewrite._rewrite_test))
 
         # written pyc files will bypass our patch, so disable reading them
         mp.setattr(
@@ -47,10 +884,297 @@ class AstAsPython(object):
 
         config._cleanup.append(mp.undo)
 
+    def configure_output(self, config):
+        self.keep = config.getoption('ast_as_python_store')
+        self.preserve_lines = config.getoption('ast_as_python_preserve_lines')
+        self.rendered_hook = config.hook.pytest_ast_as_python_rendered
+        sample = config.getoption('ast_as_python_sample')
+        if sample is not None:
+            self.sampler = Sampler(sample, config.getoption('ast_as_python_seed'))
+        if config.getoption('ast_as_python_format') == 'ndjson':
+            self.ndjson = NdjsonWriter(config.getoption('ast_as_python_output'))
+        if config.getoption('ast_as_python_targets'):
+            self.targets = {}
+            for path, line in config.getoption('ast_as_python_targets'):
+                self.targets.setdefault(path, []).append(line)
+        if config.getoption('ast_as_python_memory'):
+            if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+                raise pytest.UsageError(
+                    '--ast-as-python-memory needs Python 3.9 or later')
+            self.memory = MemoryTracker()
+            self.memory_output = config.getoption('ast_as_python_memory_output')
+        if config.getoption('ast_as_python_selected'):
+            self.deferred = []
+        if config.getoption('ast_as_python_profile'):
+            self.profile = codegen.VisitorProfile()
+        if config.getoption('ast_as_python_cache'):
+            self.cache = RenderCache(
+                config.getoption('ast_as_python_cache'),
+                config.getoption('ast_as_python_cache_size'))
+            self.cache.start()
+        if config.getoption('ast_as_python_workers') > 0:
+            self.pool = ThreadPool(config.getoption('ast_as_python_workers'))
+
+    def pytest_report_header(self, config):
+        if config.getoption('ast_as_python'):
+            return 'ast-back-to-python: %s codegen' % (
+                'compiled' if codegen.COMPILED else 'pure Python')
+
+    def relative_name(self, path):
+        if path is None:
+            return '<unknown>'
+        return os.path.relpath(path, self.rootdir).replace(os.sep, '/')
+
+    def rewritten(self, tree, path, rewrite_time, source=None, nodes=None):
+        """Take in a freshly rewritten tree, and return its module unless
+        it is filtered out."""
+        if self.targets is not None and (
+                path is None or normalize_path(path) not in self.targets):
+            return None
+        module = RewrittenModule(
+            self.relative_name(path), path, tree, rewrite_time,
+            source, nodes)
+        if self.deferred is not None:
+            with self.lock:
+                if self.selected is None:
+                    # still collecting, wait to know what's selected
+                    self.deferred.append(module)
+                    return module
+            if path is None or normalize_path(path) not in self.selected:
+                return module
+        self.offer(module)
+        return module
+
+    def offer(self, module):
+        if self.sampler is None or self.sampler.offer(module):
+            self.submit(module)
+
+    def pytest_collection_finish(self, session):
+        if self.deferred is None:
+            return
+        with self.lock:
+            self.selected = set(item_path(item) for item in session.items)
+            deferred, self.deferred = self.deferred, []
+        for module in deferred:
+            if module.path is not None and (
+                    normalize_path(module.path) in self.selected):
+                self.offer(module)
+
+    def submit(self, module):
+        if (self.keep and self.ndjson is None and self.targets is None and
+                not has_implementations(self.rendered_hook)):
+            # generated and vendored suites are full of identical modules,
+            # only render those once. The same source always rewrites to the
+            # same tree, and hashing the bytes pytest read is far cheaper
+            # than hashing the tree
+            key = module.source_sha1
+            with self.lock:
+                first = self.unique.get(key)
+                if first is not None:
+                    self.aliases.setdefault(first, []).append(module.name)
+                    return
+                if key is not None:
+                    self.unique[key] = module.name
+
+        if self.pool is not None:
+            # the tree is only read while rendering, so it doesn't matter
+            # that pytest compiles it at the same time
+            result = self.pool.apply_async(self.render, (module,))
+            with self.lock:
+                self.pending.append(result)
+        else:
+            self.add(self.render(module))
+
+    def add(self, entries):
+        with self.lock:
+            self.store.extend(entries)
+
+    def finish(self):
+        """Render what is left, and wait for the pool to be done."""
+        if self.sampler is not None:
+            for module in self.sampler.selected():
+                self.submit(module)
+            self.sampler.heap = []
+        if self.pool is not None:
+            # in submission order, to match the output of inline rendering
+            for result in self.pending:
+                self.add(result.get())
+            self.pending = []
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def render(self, module):
+        """Render a module, and return the ``(name, source)`` entries to
+        store for it."""
+        # one profile per module, as modules may be rendered on several threads
+        profile = codegen.VisitorProfile() if self.profile is not None else None
+        if self.memory is not None:
+            before = self.memory.start()
+        start = timer()
+        try:
+            if self.ndjson is not None or self.targets is not None:
+                source, source_map = codegen.to_source_with_map(
+                    module.tree, correct_line_numbers=self.preserve_lines,
+                    profile=profile)
+            elif self.cache is not None and profile is None and (
+                    module.source_sha1 is not None):
+                key = self.cache_key(module)
+                source, source_map = self.cache.get(key), None
+                if source is None:
+                    source = codegen.to_source(
+                        module.tree, correct_line_numbers=self.preserve_lines)
+                    self.cache.put(key, source)
+            else:
+                source, source_map = codegen.to_source(
+                    module.tree, correct_line_numbers=self.preserve_lines,
+                    profile=profile), None
+        finally:
+            module.render_time = timer() - start
+            if self.memory is not None:
+                render_peak = self.memory.stop(before)
+        if self.memory is not None:
+            self.memory.record(module.name, render=render_peak)
+        if profile is not None:
+            with self.lock:
+                self.profile.merge(profile)
+        # checked for each module, as conftest files register implementations
+        # during collection
+        if has_implementations(self.rendered_hook):
+            self.rendered_hook(
+                path=module.path, tree=module.tree, source=source,
+                timings={'rewrite': module.rewrite_time,
+                         'render': module.render_time})
+        if self.ndjson is not None:
+            # streamed out as we go, so there's no need to hold on to it
+            self.ndjson.write(module, source, source_map)
+            return [(module.name, None)]
+        elif not self.keep:
+            return [(module.name, None)]
+        elif self.targets is not None:
+            return list(self.select_lines(module, source, source_map))
+        else:
+            return [(module.name, source)]
+
+    def cache_key(self, module):
+        """Key a module in the cache by what its rendering depends on, all
+        known before rendering and cheap to hash: its source, pytest and
+        Python, the cache format and the rendering options."""
+        stamp = '%s, cache v%d, preserve lines %s' % (
+            source_stamp(module.source_sha1), RenderCache.VERSION,
+            self.preserve_lines)
+        return hashlib.sha1(stamp.encode('ascii')).hexdigest()
+
+    def select_lines(self, module, source, source_map):
+        """Pick the rendered lines of each target out of a whole module."""
+        lines = source.splitlines(True)
+        for line in sorted(self.targets[normalize_path(module.path)]):
+            first = statement_line(module.tree, line)
+            selected = [
+                text for text, lineno in zip(lines, source_map)
+                if first is not None and lineno == first
+            ]
+            if not selected:
+                selected = ['no statement on line %d\n' % line]
+            yield '%s:%d' % (module.name, line), ''.join(selected)
+
+    def pytest_unconfigure(self, config):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        if self.ndjson is not None:
+            self.ndjson.close()
+        if self.memory is not None:
+            self.memory.close()
+        if self.cache is not None:
+            self.cache.close()
+
     def pytest_terminal_summary(self, terminalreporter):
-        if not terminalreporter.config.getoption('ast_as_python'):
+        if self.exporter is not None:
+            terminalreporter._tw.sep("=", "Rewritten AST as Python export")
+            if self.exporter.export_dir:
+                terminalreporter.write_line('exported %d modules to %s' % (
+                    self.exporter.exported, self.exporter.export_dir))
+            if self.exporter.load_dir:
+                terminalreporter.write_line('loaded %d modules from %s' % (
+                    self.exporter.loaded, self.exporter.load_dir))
+
+        if self.stats is not None:
+            terminalreporter._tw.sep("=", "Rewritten AST as Python statistics")
+            for line in self.stats.lines():
+                terminalreporter.write_line(line)
+
+        if not self.show:
             return
 
-        for source in self.store:
+        self.finish()
+
+        if self.ndjson is not None:
             terminalreporter._tw.sep("=", "Rewritten AST as Python")
-            terminalreporter.write(source)
+            terminalreporter.write_line('wrote %d ndjson records to %s' % (
+                self.ndjson.count, self.ndjson.path))
+        elif not self.keep:
+            terminalreporter._tw.sep("=", "Rewritten AST as Python")
+            terminalreporter.write_line(
+                'rendered %d modules, not kept (--ast-as-python-no-store)' % (
+                    len(self.store)))
+        else:
+            for name, source in self.store:
+                title = "Rewritten AST as Python"
+                if self.targets is not None:
+                    title += ': ' + name
+                terminalreporter._tw.sep("=", title)
+                terminalreporter.write(source)
+                if name in self.aliases:
+                    names = [name] + self.aliases[name]
+                    terminalreporter.write_line(
+                        'shown once for %d identical modules: %s' % (
+                            len(names), ', '.join(names)))
+
+        if self.sampler is not None:
+            names = []
+            for name, source in self.store:
+                names.append(name)
+                names.extend(self.aliases.get(name, []))
+            terminalreporter._tw.sep("=", "Rewritten AST as Python sample")
+            terminalreporter.write_line(
+                'sampled %d of %d rewritten modules (seed %s):' % (
+                    len(names), self.sampler.seen, self.sampler.seed))
+            for name in names:
+                terminalreporter.write_line('    %s' % name)
+
+        if self.profile is not None:
+            terminalreporter._tw.sep("=", "Rewritten AST as Python profile")
+            for line in self.profile.table():
+                terminalreporter.write_line(line)
+
+        if self.cache is not None:
+            # wait for the last eviction pass, to count it in
+            self.cache.close()
+            terminalreporter._tw.sep("=", "Rewritten AST as Python cache")
+            terminalreporter.write_line(
+                '%d hits, %d misses, %d written, %d evicted in %s' % (
+                    self.cache.hits, self.cache.misses, self.cache.writes,
+                    self.cache.evictions, self.cache.root))
+
+        if self.memory is not None:
+            self.report_memory(terminalreporter)
+
+    def report_memory(self, terminalreporter):
+        report = self.memory.report(self.store)
+        terminalreporter._tw.sep("=", "Rewritten AST as Python memory")
+        terminalreporter.write_line('%12s %12s  %s' % (
+            'rewrite peak', 'render peak', 'module'))
+        for module in report['modules']:
+            terminalreporter.write_line('%12s %12s  %s' % (
+                format_kib(module['rewrite']), format_kib(module['render']),
+                module['path']))
+        terminalreporter.write_line('store: %s in %d entries' % (
+            format_kib(report['store_size']), report['store_entries']))
+        terminalreporter.write_line('high-water mark: %s traced' % (
+            format_kib(report['high_water'])))
+        if self.memory_output is not None:
+            with open(self.memory_output, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            terminalreporter.write_line(
+                'wrote memory report to %s' % self.memory_output)
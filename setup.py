@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import codecs
 from setuptools import setup
+from setuptools.command.build_ext import build_ext
 
 
 def read(fname):
@@ -11,6 +13,37 @@ def read(fname):
     return codecs.open(file_path, encoding='utf-8').read()
 
 
+class optional_build_ext(build_ext):
+    """Don't fail the install if the compiled codegen can't be built:
+    codegen.py is installed either way and is used instead."""
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            self.warn('not building the compiled codegen: %s' % e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            self.warn('not building the compiled codegen: %s' % e)
+
+
+def ext_modules():
+    # opt in with AST_BACK_TO_PYTHON_COMPILE=1, Cython is only needed then
+    if not os.environ.get('AST_BACK_TO_PYTHON_COMPILE'):
+        return []
+    try:
+        from Cython.Build import cythonize
+    except ImportError:
+        sys.stderr.write('Cython is not installed, not compiling codegen\n')
+        return []
+    return cythonize(
+        ['codegen.py'],
+        compiler_directives={'language_level': sys.version_info[0]})
+
+
 setup(
     name='pytest-ast-back-to-python',
     version='0.1.0',
@@ -22,7 +55,10 @@ setup(
     url='https://github.com/tomviner/pytest-ast-back-to-python',
     description='A plugin for pytest devs to view how assertion rewriting recodes the AST',
     long_description=read('README.rst'),
-    py_modules=['pytest_ast_back_to_python', 'codegen'],
+    py_modules=['pytest_ast_back_to_python', 'codegen', 'ast_as_python_daemon',
+                'ast_as_python_hooks', 'ast_as_python_cache'],
+    ext_modules=ext_modules(),
+    cmdclass={'build_ext': optional_build_ext},
     install_requires=['pytest>=2.8.1'],
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import sys
+
+import pytest
 
 
 def test_ast_as_python_on(testdir):
@@ -65,3 +69,498 @@ def test_help_message(testdir):
         'ast-back-to-python:',
         '*--show-ast-as-python*Show how assertion rewriting recoded the AST.',
     ])
+
+
+def test_sample_count_is_stable(testdir):
+    """Given a sample size, the same modules should be picked every run."""
+    for name in 'abcde':
+        testdir.makepyfile(**{'test_%s' % name: """
+            def test_it():
+                assert '%s'
+        """ % name})
+
+    outputs = []
+    for _ in range(2):
+        result = testdir.runpytest(
+            '--show-ast-as-python',
+            '--ast-as-python-sample=2',
+            '--ast-as-python-seed=42',
+        )
+        result.stdout.fnmatch_lines([
+            '*sampled 2 of 5 rewritten modules (seed 42):',
+        ])
+        lines = result.stdout.str().splitlines()
+        start = lines.index(
+            'sampled 2 of 5 rewritten modules (seed 42):')
+        outputs.append(lines[start + 1:start + 3])
+        assert result.stdout.str().count('Rewritten AST as Python ==') == 2
+        assert result.ret == 0
+
+    assert outputs[0] == outputs[1]
+    assert all(line.strip().startswith('test_') for line in outputs[0])
+
+
+def test_sample_percent(testdir):
+    """Given a 0% sample, no module should be rendered."""
+    testdir.makepyfile("""
+        def test_it():
+            assert 1
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-sample=0%',
+    )
+    result.stdout.fnmatch_lines([
+        '*sampled 0 of 1 rewritten modules (seed 0):',
+    ])
+    assert '@py_assert' not in result.stdout.str()
+    assert result.ret == 0
+
+
+def test_sample_invalid(testdir):
+    result = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-sample=lots',
+    )
+    result.stderr.fnmatch_lines([
+        '*expected a module count N or a percentage PCT%*',
+    ])
+    assert result.ret != 0
+
+
+def test_ndjson_format(testdir):
+    """Given the ndjson format, I should get one JSON record per module."""
+    import json
+
+    source = testdir.makepyfile("""
+        def test_ndjson_format(request):
+            assert request.config.getoption('ast_as_python')
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-format=ndjson',
+        '--ast-as-python-output=out.ndjson',
+    )
+    result.stdout.fnmatch_lines([
+        '*wrote 1 ndjson records to out.ndjson',
+    ])
+    assert '@py_assert' not in result.stdout.str()
+
+    lines = testdir.tmpdir.join('out.ndjson').read().splitlines()
+    assert len(lines) == 1
+    record = json.loads(lines[0])
+    assert record['path'] == 'test_ndjson_format.py'
+    assert record['source_sha1'] == hashlib.sha1(source.read('rb')).hexdigest()
+    assert record['nodes'] > 0
+    assert record['rewrite_time'] >= 0
+    assert record['render_time'] >= 0
+    assert record['size'] == len(record['source'].encode('utf-8'))
+    assert '@py_assert1 = request.config' in record['source']
+    assert result.ret == 0
+
+
+def test_ndjson_byte_source(tmpdir):
+    """A byte string rendered by codegen on Python 2 should be written out
+    as text, with the hash of the source it was given."""
+    import ast
+    import json
+    from pytest_ast_back_to_python import NdjsonWriter, RewrittenModule
+
+    writer = NdjsonWriter(str(tmpdir.join('out.ndjson')))
+    module = RewrittenModule(
+        'test_bytes.py', None, ast.parse(''), 0.0, source=b'x = 1\n', nodes=1)
+    writer.write(module, u'x = "\xe9"\n'.encode('utf-8'), [0, 1])
+    writer.close()
+
+    record = json.loads(tmpdir.join('out.ndjson').read())
+    assert record['source'] == u'x = "\xe9"\n'
+    assert record['size'] == 9
+    assert record['source_sha1'] == hashlib.sha1(b'x = 1\n').hexdigest()
+    assert record['nodes'] == 1
+
+
+def test_target_line(testdir):
+    """Given a FILE:LINE target, I should only see that statement's code."""
+    testdir.makepyfile(test_target="""
+        def test_one():
+            assert 1 == 1
+
+        def test_two():
+            x = 'two'
+            assert x == 'two'
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-target=test_target.py:6',
+    )
+    result.stdout.fnmatch_lines([
+        '*Rewritten AST as Python: test_target.py:6*',
+        "*@py_assert* = 'two'",
+    ])
+    assert "x = 'two'" not in result.stdout.str()
+    assert 'def test_one' not in result.stdout.str()
+    assert result.ret == 0
+
+
+def test_target_inside_statement(testdir):
+    """A target line inside a statement should show the whole statement,
+    and a line outside of any should say so."""
+    testdir.makepyfile(test_target="""
+        def test_long():
+            x = 'long'
+            assert x == (
+                'long')
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-target=test_target.py:4',
+        '--ast-as-python-target=test_target.py:40',
+    )
+    result.stdout.fnmatch_lines([
+        '*Rewritten AST as Python: test_target.py:4*',
+        "*@py_assert* = 'long'",
+    ])
+    assert "x = 'long'" not in result.stdout.str()
+    if sys.version_info >= (3, 8):
+        result.stdout.fnmatch_lines([
+            '*Rewritten AST as Python: test_target.py:40*',
+            'no statement on line 40',
+        ])
+    assert result.ret == 0
+
+
+def test_report_header(testdir):
+    import codegen
+
+    testdir.makepyfile("""
+        def test_it():
+            assert 1
+    """)
+    result = testdir.runpytest('--show-ast-as-python')
+    result.stdout.fnmatch_lines([
+        'ast-back-to-python: %s codegen' % (
+            'compiled' if codegen.COMPILED else 'pure Python'),
+    ])
+
+
+def test_workers(testdir):
+    """Rendering on a thread pool should give the same output, in order."""
+    for name in 'abc':
+        testdir.makepyfile(**{'test_%s' % name: """
+            def test_%s(request):
+                assert request.node.name == 'test_%s'
+        """ % (name, name)})
+
+    inline = testdir.runpytest('--show-ast-as-python')
+    threaded = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-workers=2',
+    )
+
+    def rendered(result):
+        lines = result.stdout.lines
+        return [line for line in lines if '@py_' in line or 'def ' in line]
+
+    assert rendered(threaded) == rendered(inline)
+    assert len(rendered(threaded)) > 3
+    assert threaded.ret == 0
+
+
+def test_multiline_string_literal(testdir):
+    """Long multi-line strings should be shown as triple-quoted strings."""
+    testdir.makepyfile(r"""
+        FIXTURE = 'SELECT *\nFROM t\nWHERE path = "C:\\new"\n'
+
+        def test_fixture():
+            assert FIXTURE
+    """)
+    result = testdir.runpytest('--show-ast-as-python')
+    result.stdout.fnmatch_lines([
+        "FIXTURE = '''SELECT *",
+        'FROM t',
+        'WHERE path = "C:\\\\new"',
+        "'''",
+    ])
+    assert result.ret == 0
+
+
+def test_identical_modules_rendered_once(testdir):
+    """Identical modules should be shown once, with the list of their paths."""
+    for name in 'abc':
+        testdir.makepyfile(**{'test_%s' % name: """
+            def test_it(request):
+                assert request.node.name == 'test_it'
+        """})
+    testdir.makepyfile(test_d="""
+        def test_it(request):
+            assert request.node.name != 'test_d'
+    """)
+    result = testdir.runpytest('--show-ast-as-python')
+    result.stdout.fnmatch_lines([
+        'shown once for 3 identical modules: test_a.py, test_b.py, test_c.py',
+    ])
+    assert result.stdout.str().count('Rewritten AST as Python ==') == 2
+    assert result.ret == 0
+
+
+def test_profile(testdir):
+    """Given the profile option, I should see the time spent per visitor."""
+    testdir.makepyfile("""
+        def test_profile(request):
+            assert request.config.getoption('ast_as_python_profile')
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-profile',
+    )
+    result.stdout.fnmatch_lines([
+        '*Rewritten AST as Python profile*',
+        '*calls*own s*cum s*chars*method',
+    ])
+    result.stdout.fnmatch_lines([
+        '* visit_Call',
+    ])
+    result.stdout.fnmatch_lines([
+        '* visit_Module',
+    ])
+    assert result.ret == 0
+
+
+def test_memory_report(testdir):
+    """Given the memory option, I should see peaks per module, as JSON too."""
+    import json
+
+    tracemalloc = pytest.importorskip('tracemalloc')
+    if not hasattr(tracemalloc, 'reset_peak'):
+        pytest.skip('needs Python 3.9+')
+    testdir.makepyfile("""
+        def test_memory(request):
+            assert request.config.getoption('ast_as_python_memory')
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-memory',
+        '--ast-as-python-memory-output=memory.json',
+    )
+    result.stdout.fnmatch_lines([
+        '*Rewritten AST as Python memory*',
+        '*rewrite peak*render peak*module',
+        '* KiB * KiB  test_memory_report.py',
+        'store: * KiB in 1 entries',
+        'high-water mark: * KiB traced',
+    ])
+    report = json.loads(testdir.tmpdir.join('memory.json').read())
+    module, = report['modules']
+    assert module['path'] == 'test_memory_report.py'
+    assert module['rewrite'] > 0
+    assert module['render'] > 0
+    assert report['store_size'] > 0
+    assert report['high_water'] >= module['render']
+    assert result.ret == 0
+
+
+def test_selected_only(testdir):
+    """Given the selected option, deselected modules should not be shown."""
+    testdir.makepyfile(test_kept="""
+        def test_kept():
+            assert 'kept'
+    """)
+    testdir.makepyfile(test_dropped="""
+        def test_dropped():
+            assert 'dropped'
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-selected',
+        '-k', 'kept',
+    )
+    assert "'kept'" in result.stdout.str()
+    assert "'dropped'" not in result.stdout.str()
+    assert result.stdout.str().count('Rewritten AST as Python ==') == 1
+    assert result.ret == 0
+
+
+def test_rendered_hook(testdir):
+    """Other plugins should get each rendered module through a hook."""
+    testdir.makeconftest("""
+        import os
+
+        rendered = []
+
+        def pytest_ast_as_python_rendered(path, tree, source, timings):
+            rendered.append((os.path.basename(path), source, timings))
+
+        def pytest_terminal_summary(terminalreporter):
+            for name, source, timings in rendered:
+                terminalreporter.write_line('hooked %s: %s %s' % (
+                    name, '@py_assert' in source, sorted(timings)))
+    """)
+    testdir.makepyfile(test_hooked="""
+        def test_hooked(request):
+            assert request.node.name
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python',
+        '--ast-as-python-no-store',
+    )
+    result.stdout.fnmatch_lines([
+        "hooked test_hooked.py: True ['render', 'rewrite']",
+    ])
+    result.stdout.fnmatch_lines([
+        'rendered 1 modules, not kept (--ast-as-python-no-store)',
+    ])
+    assert '@py_assert' not in result.stdout.str()
+    assert result.ret == 0
+
+
+def test_export_and_load(testdir):
+    """Exported modules should be valid Python, and their code be used
+    instead of rewriting as long as their source doesn't change."""
+    source = testdir.makepyfile(test_exported="""
+        def test_passes():
+            assert 1
+
+        def test_fails():
+            x = 1
+            assert x == 2
+    """)
+    result = testdir.runpytest('--ast-as-python-export=.exported')
+    result.stdout.fnmatch_lines([
+        'exported 1 modules to .exported',
+    ])
+    exported = testdir.tmpdir.join('.exported', 'test_exported.py')
+    text = exported.read()
+    assert '_at_py_assert' in text
+    assert '@py' not in text
+    compile(text, str(exported), 'exec')
+    assert testdir.tmpdir.join('.exported', 'test_exported.py.marshal').check()
+
+    if sys.version_info < (3,):
+        result = testdir.runpytest('--ast-as-python-load=.exported')
+        result.stderr.fnmatch_lines([
+            '*--ast-as-python-load needs Python 3',
+        ])
+        return
+
+    # loaded modules aren't rewritten, so the statistics don't count them
+    result = testdir.runpytest(
+        '--ast-as-python-load=.exported', '--ast-as-python-stats')
+    result.stdout.fnmatch_lines([
+        '*assert 1 == 2',
+        'test_exported.py:6: AssertionError',
+    ])
+    result.stdout.fnmatch_lines([
+        '*1 failed, 1 passed*',
+    ])
+    result.stdout.fnmatch_lines([
+        'loaded 1 modules from .exported',
+    ])
+    result.stdout.fnmatch_lines([
+        'pytest * rewrote 0 asserts in 0 modules',
+    ])
+
+    source.write(source.read() + '# changed\n')
+    result = testdir.runpytest(
+        '--ast-as-python-load=.exported', '--ast-as-python-stats')
+    result.stdout.fnmatch_lines([
+        'loaded 0 modules from .exported',
+    ])
+    result.stdout.fnmatch_lines([
+        'pytest * rewrote 2 asserts in 1 modules',
+    ])
+
+
+def test_cache(testdir):
+    """A later run should take identical modules from the cache, and the
+    cache should be kept under its size cap."""
+    testdir.makepyfile(test_cached="""
+        def test_cached():
+            assert 1 == 1
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python', '--ast-as-python-cache=.render-cache')
+    result.stdout.fnmatch_lines([
+        '*Rewritten AST as Python cache*',
+        '0 hits, 1 misses, 1 written, 0 evicted in .render-cache',
+    ])
+    result = testdir.runpytest(
+        '--show-ast-as-python', '--ast-as-python-cache=.render-cache')
+    result.stdout.fnmatch_lines([
+        '*raise AssertionError(@pytest_ar*',
+        '1 hits, 0 misses, 0 written, 0 evicted in .render-cache',
+    ])
+    # rendered differently, so cached apart
+    result = testdir.runpytest(
+        '--show-ast-as-python', '--ast-as-python-cache=.render-cache',
+        '--ast-as-python-preserve-lines')
+    result.stdout.fnmatch_lines([
+        '0 hits, 1 misses, 1 written, 0 evicted in .render-cache',
+    ])
+    result = testdir.runpytest(
+        '--show-ast-as-python', '--ast-as-python-cache=.render-cache',
+        '--ast-as-python-cache-size=1')
+    # whether the hit comes before the first eviction pass is up to the
+    # eviction thread, but nothing may be left after the last one
+    result.stdout.fnmatch_lines([
+        '*, [123] evicted in .render-cache',
+    ])
+    assert not [
+        path for path in testdir.tmpdir.join('.render-cache').visit()
+        if path.check(file=1)
+    ]
+
+
+def test_preserve_lines(testdir):
+    """With --ast-as-python-preserve-lines, the code of each statement
+    should be on its line in the original module."""
+    import json
+
+    testdir.makepyfile(test_lines="""
+        def test_lines():
+
+            x = 1
+
+
+            assert x == 1
+    """)
+    result = testdir.runpytest(
+        '--show-ast-as-python', '--ast-as-python-preserve-lines',
+        '--ast-as-python-format=ndjson', '--ast-as-python-output=out.ndjson')
+    assert result.ret == 0
+    record = json.loads(testdir.tmpdir.join('out.ndjson').read())
+    lines = record['source'].splitlines()
+    assert lines[2].strip() == 'x = 1'
+    assert lines[5].strip().startswith('@py_assert')
+    assert record['source_map'][2] == 3
+    assert record['source_map'][5] == 6
+
+
+def test_stats(testdir):
+    """--ast-as-python-stats should count what rewriting added, without
+    rendering anything."""
+    testdir.makepyfile(test_small="""
+        def test_small():
+            x = 1
+            assert x == 1
+    """, test_big="""
+        def test_big():
+            x = 1
+            assert x == 1
+            assert x + 1 == 2
+            assert not x or x
+    """)
+    result = testdir.runpytest(
+        '--ast-as-python-stats', '--ast-as-python-stats-top=1')
+    result.stdout.fnmatch_lines([
+        '*Rewritten AST as Python statistics*',
+        'pytest * rewrote 4 asserts in 2 modules',
+        '* @py_assert temporaries, * @py_format branches',
+        'statements: 8 -> * (x*)',
+        'nodes: * -> * (x*)',
+        'node expansion per module:',
+        'most expanded modules:',
+        '*added nodes*ratio*asserts*module',
+        '* x* *3  test_big.py',
+    ])
+    assert '  test_small.py' not in result.stdout.str()
+    assert 'def test_big' not in result.stdout.str()
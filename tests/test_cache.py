@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+from ast_as_python_cache import RenderCache
+
+
+def entries(cache):
+    return sorted(
+        name for _, _, names in os.walk(cache.directory) for name in names)
+
+
+def test_get_put(tmpdir):
+    cache = RenderCache(str(tmpdir), 1 << 20)
+    assert cache.get('ab' * 20) is None
+    cache.put('ab' * 20, u'x = ☃\n')
+    assert cache.get('ab' * 20) == u'x = ☃\n'
+    assert (cache.hits, cache.misses, cache.writes) == (1, 1, 1)
+    assert entries(cache) == ['ab' * 19]
+
+
+def test_evicts_least_recently_used(tmpdir):
+    cache = RenderCache(str(tmpdir), 25)
+    for n, key in enumerate(['aa' * 20, 'bb' * 20, 'cc' * 20]):
+        cache.put(key, u'%d' % n * 10)
+        # modification times may be too coarse to order the entries
+        os.utime(cache.path(key), (n, n))
+    os.utime(cache.path('aa' * 20), (5, 5))
+    cache.start()
+    cache.close()
+    assert cache.evictions == 1
+    assert cache.get('bb' * 20) is None
+    assert cache.get('aa' * 20) is not None
+
+
+def test_concurrent_readers_see_whole_entries(tmpdir):
+    writer = RenderCache(str(tmpdir), 1 << 20)
+    reader = RenderCache(str(tmpdir), 1 << 20)
+    key = 'cd' * 20
+    source = u'assert x\n' * 10000
+    seen = []
+    done = []
+
+    def read():
+        while not done:
+            seen.append(reader.get(key))
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    try:
+        for _ in range(20):
+            writer.put(key, source)
+            time.sleep(0.001)
+    finally:
+        done.append(True)
+        thread.join()
+    assert set(seen) <= set([None, source])
+    assert not [name for name in entries(writer) if name.startswith('.tmp-')]
+
+
+def test_evicts_older_versions(tmpdir):
+    old = tmpdir.join('v1', 'ab', 'cd' * 19).ensure()
+    old.write('x' * 100)
+    tmpdir.join('not-the-cache').write('x' * 100)
+    cache = RenderCache(str(tmpdir), 50)
+    cache.start()
+    cache.close()
+    assert cache.evictions == 1
+    assert not old.check()
+    assert tmpdir.join('not-the-cache').check()
+
+
+def test_evicts_older_versions_first(tmpdir):
+    cache = RenderCache(str(tmpdir), 150)
+    cache.put('ab' * 20, u'x' * 100)
+    old = tmpdir.join('v1', 'ab', 'cd' * 19).ensure()
+    old.write('x' * 100)
+    # more recently used than the current entry
+    os.utime(str(old), None)
+    os.utime(cache.path('ab' * 20), (1, 1))
+    cache.evict()
+    assert cache.evictions == 1
+    assert not old.check()
+    assert cache.get('ab' * 20) == u'x' * 100
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import ast
+
+import codegen
+
+SOURCE = '''
+def test_it(x, y=-0.0):
+    assert x.y(1, 1.0, True) == [u'\\u2603', b'b', 1j, None]
+    assert x or not y, 'message %r' % (x,)
+'''
+
+
+def rewritten_tree():
+    from _pytest.assertion.rewrite import rewrite_asserts
+
+    tree = ast.parse(SOURCE)
+    try:
+        rewrite_asserts(tree, SOURCE.encode('utf-8'))
+    except TypeError:
+        # pytest < 5 doesn't take the source
+        rewrite_asserts(tree)
+    return tree
+
+
+def test_correct_line_numbers():
+    source = 'def f(x):\n\n    y = x\n\n\n    return (y +\n        1)\n'
+    assert codegen.to_source(ast.parse(source), correct_line_numbers=True) == (
+        'def f(x):\n\n    y = x\n\n\n    return y + \\\n        1\n')
+
+
+def test_fingerprint():
+    tree = rewritten_tree()
+    digest = codegen.fingerprint(tree)
+    assert len(digest) == 16
+    assert codegen.fingerprint(rewritten_tree()) == digest
+
+    for changed in ['1.0', 'True', "'1'"]:
+        other = ast.parse(SOURCE.replace('x.y(1,', 'x.y(%s,' % changed))
+        assert codegen.fingerprint(other) != codegen.fingerprint(ast.parse(SOURCE))
+
+
+def test_fingerprint_attributes():
+    moved = ast.parse('\n' + SOURCE)
+    assert codegen.fingerprint(moved) == codegen.fingerprint(ast.parse(SOURCE))
+    assert (codegen.fingerprint(moved, include_attributes=True) !=
+            codegen.fingerprint(ast.parse(SOURCE), include_attributes=True))
+
+
+def test_fingerprint_memo():
+    tree = rewritten_tree()
+    memo = {}
+    statements = [codegen.fingerprint(node, memo) for node in tree.body]
+    assert codegen.fingerprint(tree, memo) == codegen.fingerprint(tree)
+    assert statements == [codegen.fingerprint(node) for node in tree.body]
+    # the statements are kept alive, so their ids can't be reused
+    assert all(memo[id(node)][0] is node for node in tree.body)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from ast_as_python_daemon import Daemon, query, remove_stale_socket, render_file
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(socket, 'AF_UNIX'), reason='needs Unix sockets')
+
+
+@pytest.fixture
+def daemon(request, tmpdir):
+    tests = tmpdir.mkdir('tests')
+    tests.join('test_foo.py').write('def test_foo():\n    assert 1 == 1\n')
+    daemon = Daemon(str(tmpdir.join('sock')), [str(tests)], interval=0.05)
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    for _ in range(100):
+        if os.path.exists(daemon.socket_path):
+            break
+        time.sleep(0.05)
+
+    def stop():
+        daemon.stop()
+        thread.join()
+    request.addfinalizer(stop)
+    return daemon
+
+
+def test_render_file(tmpdir):
+    path = tmpdir.join('test_bar.py')
+    path.write('def test_bar(x):\n    assert x.y\n')
+    assert '@py_assert1 = x.y' in render_file(str(path))
+
+
+def test_query(daemon, tmpdir):
+    path = str(tmpdir.join('tests', 'test_foo.py'))
+    assert '@py_assert0 = 1' in query(daemon.socket_path, path)
+
+
+def test_rerender_on_change(daemon, tmpdir):
+    path = tmpdir.join('tests', 'test_foo.py')
+    before = query(daemon.socket_path, str(path))
+
+    path.write('def test_foo(x):\n    assert x.changed\n')
+    # make sure the change is seen even on filesystems with coarse mtimes
+    os.utime(str(path), (time.time() + 5, time.time() + 5))
+    for _ in range(100):
+        after = query(daemon.socket_path, str(path))
+        if after != before:
+            break
+        time.sleep(0.05)
+    assert '@py_assert1 = x.changed' in after
+
+
+def test_syntax_error(daemon, tmpdir):
+    path = tmpdir.join('tests', 'test_broken.py')
+    path.write('def test_broken(:\n')
+    assert query(daemon.socket_path, str(path)).startswith('error: ')
+
+
+def test_bad_query_answers_error(daemon, tmpdir):
+    """A query that can't be rendered should get an error, and leave the
+    daemon serving."""
+    assert query(daemon.socket_path, str(tmpdir.join('tests'))).startswith('error: ')
+    path = str(tmpdir.join('tests', 'test_foo.py'))
+    assert '@py_assert0 = 1' in query(daemon.socket_path, path)
+
+
+def test_forget_deleted(daemon, tmpdir):
+    path = tmpdir.join('tests', 'test_foo.py')
+    assert str(path) in daemon.rendered
+    path.remove()
+    for _ in range(100):
+        if str(path) not in daemon.rendered:
+            break
+        time.sleep(0.05)
+    assert str(path) not in daemon.rendered
+    assert query(daemon.socket_path, str(path)).startswith('error: ')
+
+
+def test_remove_stale_socket(tmpdir):
+    path = str(tmpdir.join('sock'))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    try:
+        remove_stale_socket(path)
+        # still listening
+        assert os.path.exists(path)
+    finally:
+        server.close()
+    remove_stale_socket(path)
+    assert not os.path.exists(path)
+
+    other = tmpdir.join('other')
+    other.write('not a socket')
+    remove_stale_socket(str(other))
+    assert other.read() == 'not a socket'